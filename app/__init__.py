@@ -0,0 +1,4 @@
+import time
+
+# Start of the import-to-ready time reported by the readiness endpoint
+IMPORTED_AT = time.monotonic()
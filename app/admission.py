@@ -0,0 +1,128 @@
+import asyncio
+import math
+from typing import AsyncIterator, Callable, Dict, Optional
+
+from fastapi import Depends, HTTPException
+
+from .config import settings
+from .database import get_tenant
+from .metrics import ADMISSION_REJECTED, ADMISSION_WAIT, TENANT_REJECTED, TENANT_REQUESTS
+from .tenants import Tenant
+
+ROUTE_CLASSES = ('reads', 'writes', 'bulk', 'admin')
+
+
+class Overloaded(Exception):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class AdmissionLimiter:
+    """Bounds the requests of a route class running at once, with a bounded wait queue and a deadline.
+
+    A request is rejected straight away when queue_size requests are already waiting, and after
+    waiting timeout seconds for a slot. A concurrency of 0 disables the limit.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int, timeout: float):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.waiting = 0
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    async def acquire(self) -> None:
+        if not self.concurrency:
+            return
+        if self.semaphore is None:
+            # Created on first use so it belongs to the running event loop
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        if not self.semaphore.locked():
+            await self.semaphore.acquire()
+            return
+        if self.waiting >= self.queue_size:
+            raise Overloaded('queue_full')
+
+        self.waiting += 1
+        loop = asyncio.get_event_loop()
+        started = loop.time()
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded('deadline')
+        finally:
+            self.waiting -= 1
+            ADMISSION_WAIT.labels(self.name).observe(loop.time() - started)
+
+    def release(self) -> None:
+        if self.concurrency:
+            self.semaphore.release()
+
+    @property
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.timeout))
+
+
+limiters: Dict[str, AdmissionLimiter] = {
+    route_class: AdmissionLimiter(
+        route_class,
+        concurrency=getattr(settings, f'admission_{route_class}_concurrency'),
+        queue_size=getattr(settings, f'admission_{route_class}_queue'),
+        timeout=getattr(settings, f'admission_{route_class}_timeout'),
+    )
+    for route_class in ROUTE_CLASSES
+}
+# One limiter per tenant, shared by all its route classes
+tenant_limiters: Dict[str, AdmissionLimiter] = {}
+
+
+def tenant_limiter(tenant: str) -> AdmissionLimiter:
+    if tenant not in tenant_limiters:
+        tenant_limiters[tenant] = AdmissionLimiter(
+            'tenant',
+            concurrency=settings.tenant_concurrency,
+            queue_size=settings.tenant_queue,
+            timeout=settings.tenant_timeout,
+        )
+    return tenant_limiters[tenant]
+
+
+def admit(route_class: str) -> Callable[..., AsyncIterator[None]]:
+    """Dependency holding a slot of the tenant and of route_class for the whole request, or answering 503 if overloaded.
+
+    The tenant's slot is taken first, so a tenant over its quota waits without holding slots other tenants need.
+    """
+    assert route_class in ROUTE_CLASSES
+
+    async def dependency(tenant: Tenant = Depends(get_tenant)) -> AsyncIterator[None]:
+        quota = tenant_limiter(tenant.name)
+        try:
+            await quota.acquire()
+        except Overloaded as error:
+            TENANT_REJECTED.labels(tenant.name, error.reason).inc()
+            raise HTTPException(
+                status_code=503,
+                detail=f'Too many requests for tenant {tenant.name}, try again later',
+                headers={'Retry-After': str(quota.retry_after)},
+            )
+        limiter = limiters[route_class]
+        try:
+            await limiter.acquire()
+        except Overloaded as error:
+            quota.release()
+            ADMISSION_REJECTED.labels(route_class, error.reason).inc()
+            raise HTTPException(
+                status_code=503,
+                detail=f'Too many {route_class} requests, try again later',
+                headers={'Retry-After': str(limiter.retry_after)},
+            )
+        TENANT_REQUESTS.labels(tenant.name, route_class).inc()
+        try:
+            yield
+        finally:
+            limiter.release()
+            quota.release()
+
+    return dependency
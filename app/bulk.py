@@ -0,0 +1,212 @@
+import json
+import logging
+import time
+import zlib
+from collections import Counter
+from typing import AsyncIterator, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from motor.motor_asyncio import AsyncIOMotorCursor, AsyncIOMotorDatabase
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from .cache import invalidate_tags
+from .models import Article
+from .search import index_article
+from .tags import apply_tag_delta, tag_delta
+from .tenants import get_collection
+from .utils import article_document, article_output, dumps
+
+logger = logging.getLogger(__name__)
+
+EXPORT_CHUNK_SIZE = 64 * 1024
+DUPLICATE_KEY_ERROR = 11000
+
+
+async def articles_inserted(db: AsyncIOMotorDatabase, documents: List[dict], operation: str = 'writes') -> None:
+    """Updates tag counts, caches and the search index after articles have been inserted"""
+    if not documents:
+        return
+    delta = Counter()
+    for document in documents:
+        delta.update(tag_delta(new_tags=document['tags']))
+        index_article(db, str(document['_id']), document['content'], document['tags'])
+    await apply_tag_delta(db, delta, operation)
+    # New articles only change the pages of their tags
+    await invalidate_tags(db, delta)
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Splits a streamed request body into NDJSON lines without buffering the whole body"""
+    buffer = b''
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+async def gunzip(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Decompresses a streamed gzip body chunk by chunk"""
+    decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+    async for chunk in chunks:
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+async def export_articles(cursor: AsyncIOMotorCursor, compress: bool) -> AsyncIterator[bytes]:
+    """Streams articles as NDJSON, optionally gzipped, in chunks of about EXPORT_CHUNK_SIZE bytes"""
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if compress else None
+    buffer = bytearray()
+    exported = 0
+    started = time.perf_counter()
+    async for article in cursor:
+        buffer += dumps({**article_output(article), 'version': article.get('version', 0)}) + b'\n'
+        exported += 1
+        if len(buffer) >= EXPORT_CHUNK_SIZE:
+            yield compressor.compress(bytes(buffer)) if compressor else bytes(buffer)
+            buffer.clear()
+    if compressor:
+        yield compressor.compress(bytes(buffer)) + compressor.flush()
+    elif buffer:
+        yield bytes(buffer)
+
+    elapsed = time.perf_counter() - started
+    logger.info('Exported %d articles in %.2fs (%.0f articles/s)', exported, elapsed, exported / max(elapsed, 1e-9))
+
+
+class BulkInserter:
+    """Validates articles and writes them in unordered insert_many chunks, keeping a result per item"""
+
+    def __init__(self, db: AsyncIOMotorDatabase, chunk_size: int):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.pending: List[Tuple[int, dict]] = []
+        self.results: List[dict] = []
+        self.inserted = 0
+
+    async def add_line(self, index: int, line: bytes) -> None:
+        """Parses and adds a single NDJSON line"""
+        try:
+            item = json.loads(line)
+        except ValueError:
+            self.results.append({'index': index, 'error': 'Invalid JSON'})
+            return
+        await self.add(index, item)
+
+    async def add(self, index: int, item) -> None:
+        """Validates an item with the Article model and queues it for insertion"""
+        try:
+            document = self.document(Article.parse_obj(item), item)
+        except ValueError as error:
+            self.results.append({
+                'index': index,
+                'error': error.errors() if isinstance(error, ValidationError) else str(error),
+            })
+            return
+        self.pending.append((index, document))
+        if len(self.pending) >= self.chunk_size:
+            await self.flush()
+
+    def document(self, article: Article, item: dict) -> dict:
+        """Creates the document stored for a validated item"""
+        return article_document(article)
+
+    async def flush(self) -> None:
+        """Inserts all pending articles, a failed document does not stop the others from being written"""
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        try:
+            articles = get_collection(self.db, 'articles', 'bulk')
+            await articles.insert_many([document for _, document in pending], ordered=False)
+            write_errors = {}
+        except BulkWriteError as error:
+            write_errors = {write_error['index']: write_error['errmsg'] for write_error in error.details['writeErrors']}
+
+        inserted = []
+        for position, (index, document) in enumerate(pending):
+            if position in write_errors:
+                self.results.append({'index': index, 'error': write_errors[position]})
+            else:
+                inserted.append(document)
+                self.results.append({'index': index, 'id': str(document['_id'])})
+        self.inserted += len(inserted)
+        await articles_inserted(self.db, inserted, 'bulk')
+
+    def summary(self) -> dict:
+        """Returns the per-item results sorted by their position in the request"""
+        results = sorted(self.results, key=lambda result: result['index'])
+        return {'inserted': self.inserted, 'failed': len(results) - self.inserted, 'results': results}
+
+
+class ArticleImporter(BulkInserter):
+    """Imports exported articles, keeping their ids and versions.
+
+    Articles which already exist are skipped, so an interrupted import can be re-run from the start
+    or resumed after a checkpoint id. Only counts and the first MAX_ERRORS errors are kept in memory.
+    """
+
+    MAX_ERRORS = 100
+
+    def __init__(self, db: AsyncIOMotorDatabase, chunk_size: int, after: Optional[ObjectId] = None):
+        super().__init__(db, chunk_size)
+        self.after = after
+        self.skipped = 0
+        self.failed = 0
+        self.errors: List[dict] = []
+        self.checkpoint: Optional[ObjectId] = None
+        self.started = time.perf_counter()
+
+    async def add(self, index: int, item) -> None:
+        if self.after is not None and isinstance(item, dict) and ObjectId.is_valid(item.get('id')):
+            if ObjectId(item['id']) <= self.after:
+                self.skipped += 1
+                return
+        await super().add(index, item)
+
+    def document(self, article: Article, item: dict) -> dict:
+        document = article_document(article)
+        if 'id' in item:
+            try:
+                document['_id'] = ObjectId(item['id'])
+            except (InvalidId, TypeError):
+                raise ValueError(f"Invalid id: {item['id']}")
+        if isinstance(item.get('version'), int):
+            document['version'] = item['version']
+        return document
+
+    async def flush(self) -> None:
+        pending = self.pending
+        await super().flush()
+        for result in self.results:
+            if 'id' in result:
+                continue
+            if isinstance(result['error'], str) and f'E{DUPLICATE_KEY_ERROR}' in result['error']:
+                self.skipped += 1
+            else:
+                self.failed += 1
+                if len(self.errors) < self.MAX_ERRORS:
+                    self.errors.append(result)
+        self.results.clear()
+        if pending:
+            # Everything up to the last article of the chunk has been handled, exports are sorted by _id
+            self.checkpoint = pending[-1][1]['_id']
+
+    def summary(self) -> dict:
+        elapsed = time.perf_counter() - self.started
+        logger.info('Imported %d articles in %.2fs (%.0f articles/s)',
+                    self.inserted, elapsed, self.inserted / max(elapsed, 1e-9))
+        return {
+            'inserted': self.inserted,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': self.errors,
+            'checkpoint': str(self.checkpoint) if self.checkpoint else None,
+            'elapsed': elapsed,
+            'articles_per_second': self.inserted / max(elapsed, 1e-9),
+        }
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .config import settings
+
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after ttl seconds"""
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable):
+        """Returns a cached value or None, refreshing its LRU position"""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self.entries[key]
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value) -> None:
+        """Caches a value, evicting the least recently used entries when full"""
+        self.entries[key] = (self.clock() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate_where(self, predicate: Callable[[tuple], bool]) -> None:
+        """Removes every entry whose key matches the predicate"""
+        for key in [key for key in self.entries if predicate(key)]:
+            del self.entries[key]
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.entries),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class ArticleCache(TTLCache):
+    """Caches single articles under ('article', db, id) and tag pages under ('tag', db, tag, ...).
+
+    Every invalidation bumps the generation of its database, a read which started before an invalidation
+    does not put what it fetched back into the cache.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock: Callable[[], float] = time.monotonic):
+        super().__init__(maxsize, ttl, clock)
+        self.generations: Dict[str, int] = {}
+
+    def generation(self, db_name: str) -> int:
+        return self.generations.get(db_name, 0)
+
+    def set_unless_invalidated(self, key: tuple, value, generation: int) -> None:
+        """Caches a value read while the generation of its database was generation"""
+        if self.generation(key[1]) == generation:
+            self.set(key, value)
+
+    def invalidate_article(self, db_name: str, article_id: str, tags: Iterable[str] = ()) -> None:
+        """Removes an article and the cached pages of every tag it had or has"""
+        self.invalidate_where(lambda key: key == ('article', db_name, article_id), db_name)
+        self.invalidate_tags(db_name, tags)
+
+    def invalidate_tags(self, db_name: str, tags: Iterable[str]) -> None:
+        tags = set(tags)
+        if tags:
+            self.invalidate_where(lambda key: key[0] == 'tag' and key[1] == db_name and key[2] in tags, db_name)
+
+    def invalidate_all_tags(self, db_name: str) -> None:
+        self.invalidate_where(lambda key: key[0] == 'tag' and key[1] == db_name, db_name)
+
+    def invalidate_database(self, db_name: str) -> None:
+        self.invalidate_where(lambda key: key[1] == db_name, db_name)
+
+    def invalidate_where(self, predicate: Callable[[tuple], bool], db_name: Optional[str] = None) -> None:
+        if db_name is not None:
+            self.generations[db_name] = self.generation(db_name) + 1
+        super().invalidate_where(predicate)
+
+    def clear(self) -> None:
+        super().clear()
+        for db_name in self.generations:
+            self.generations[db_name] += 1
+
+
+class DatabaseIndexes:
+    """In-memory indexes by database, built on lookup when missing or older than ttl() seconds.
+
+    Writes made through this worker keep an index up to date, the TTL bounds how long
+    writes made by other workers are missed.
+    """
+
+    def __init__(self, build: Callable[[AsyncIOMotorDatabase], Awaitable[Any]], ttl: Callable[[], float]):
+        self.build = build
+        self.ttl = ttl
+        self.indexes: Dict[str, Any] = {}
+        self.built_at: Dict[str, float] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    def fresh(self, db_name: str) -> Optional[Any]:
+        if db_name in self.indexes and time.monotonic() - self.built_at[db_name] < self.ttl():
+            return self.indexes[db_name]
+        return None
+
+    async def get(self, db: AsyncIOMotorDatabase) -> Any:
+        index = self.fresh(db.name)
+        if index is not None:
+            return index
+        # Concurrent lookups of a stale index wait for a single rebuild
+        async with self.locks.setdefault(db.name, asyncio.Lock()):
+            index = self.fresh(db.name)
+            if index is None:
+                index = await self.build(db)
+                self.indexes[db.name] = index
+                self.built_at[db.name] = time.monotonic()
+        return index
+
+    def loaded(self, db: AsyncIOMotorDatabase) -> Optional[Any]:
+        """Returns the index of a database if it has been built, even when it is stale"""
+        return self.indexes.get(db.name)
+
+    def drop(self, db: AsyncIOMotorDatabase) -> None:
+        self.indexes.pop(db.name, None)
+        self.built_at.pop(db.name, None)
+
+    def clear(self) -> None:
+        self.indexes.clear()
+        self.built_at.clear()
+
+
+class CacheInvalidator:
+    """Invalidates this worker's cache on writes made by other workers.
+
+    Follows a single change stream on the whole deployment, filtered to articles collections and routed
+    to the cache of each followed database. Deployments without change streams (standalone mongod) fall
+    back to one task polling a generation counter in each followed database, which every write bumps.
+    Either way a worker holds at most one getMore or poll in flight, however many tenants it serves.
+    """
+
+    def __init__(self, cache: ArticleCache, poll_interval: float):
+        self.cache = cache
+        self.poll_interval = poll_interval
+        self.polling = False
+        self.databases: Dict[str, AsyncIOMotorDatabase] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self, db: AsyncIOMotorDatabase) -> None:
+        """Follows writes to a database, all databases share the task started for the first one"""
+        self.databases[db.name] = db
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run(db.client))
+
+    async def stop(self) -> None:
+        task, self.task = self.task, None
+        self.databases = {}
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self, client: AsyncIOMotorClient) -> None:
+        while True:
+            try:
+                if self.polling:
+                    await self.poll()
+                else:
+                    await self.watch(client)
+            except PyMongoError as error:
+                if isinstance(error, OperationFailure) and not self.polling:
+                    # Change streams are only supported on replica sets and sharded clusters
+                    self.polling = True
+                    continue
+                # Changes may have been missed while disconnected
+                for db_name in list(self.databases):
+                    self.cache.invalidate_database(db_name)
+                await asyncio.sleep(self.poll_interval)
+
+    async def watch(self, client: AsyncIOMotorClient) -> None:
+        async with client.watch([{'$match': {'ns.coll': 'articles'}}]) as stream:
+            async for change in stream:
+                self.apply(change)
+
+    def apply(self, change: dict) -> None:
+        """Invalidates the entries a change event touches, events of databases this worker doesn't serve are ignored"""
+        db_name = change['ns']['db']
+        if db_name not in self.databases:
+            return
+        if change['operationType'] == 'insert':
+            document = change['fullDocument']
+            self.cache.invalidate_article(db_name, str(document['_id']), document.get('tags', []))
+        elif 'documentKey' in change:
+            # Old tags are unknown for updates and deletes
+            self.cache.invalidate_article(db_name, str(change['documentKey']['_id']))
+            self.cache.invalidate_all_tags(db_name)
+        else:
+            self.cache.invalidate_database(db_name)
+
+    async def poll(self) -> None:
+        generations: Dict[str, int] = {}
+        while True:
+            # Databases followed later are picked up on the next round
+            for db_name, db in list(self.databases.items()):
+                document = await db['cache'].find_one({'_id': 'generation'})
+                value = document['value'] if document else 0
+                if db_name in generations and value != generations[db_name]:
+                    self.cache.invalidate_database(db_name)
+                generations[db_name] = value
+            await asyncio.sleep(self.poll_interval)
+
+    async def bump(self, db: AsyncIOMotorDatabase) -> None:
+        """Signals a write to polling workers, a no-op while change streams are available"""
+        if self.polling:
+            await db['cache'].update_one({'_id': 'generation'}, {'$inc': {'value': 1}}, upsert=True)
+
+
+article_cache = ArticleCache(maxsize=settings.cache_maxsize, ttl=settings.cache_ttl)
+invalidator = CacheInvalidator(article_cache, poll_interval=settings.cache_poll_interval)
+
+
+async def invalidate_article(db: AsyncIOMotorDatabase, article_id: str, tags: Iterable[str] = ()) -> None:
+    """Invalidates an article and its tags in this worker and signals the other workers"""
+    article_cache.invalidate_article(db.name, article_id, tags)
+    await invalidator.bump(db)
+
+
+async def invalidate_tags(db: AsyncIOMotorDatabase, tags: Iterable[str]) -> None:
+    """Invalidates the pages of some tags in this worker and signals the other workers"""
+    article_cache.invalidate_tags(db.name, tags)
+    await invalidator.bump(db)
+
+
+async def invalidate_database(db: AsyncIOMotorDatabase) -> None:
+    """Invalidates every cached entry of a database in this worker and signals the other workers"""
+    article_cache.invalidate_database(db.name)
+    await invalidator.bump(db)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import BulkWriteError, WriteConcernError, WriteError
+
+from .bulk import articles_inserted
+from .config import settings
+from .tenants import get_collection
+
+logger = logging.getLogger(__name__)
+
+
+class InsertBatcher:
+    """Coalesces concurrent single article inserts into unordered insert_many batches.
+
+    A batch is written once it holds max_batch_size articles or max_delay seconds after its first
+    article arrived. Every caller still gets its own inserted id or its own error.
+    """
+
+    def __init__(self, enabled: bool, max_batch_size: int, max_delay: float):
+        self.enabled = enabled
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def insert(self, db: AsyncIOMotorDatabase, document: dict):
+        """Queues a document for the next batch and waits until it has been written"""
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.ensure_future(self.run())
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put((db, document, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.write(batch)
+            except Exception:
+                logger.exception('Failed to write a batch of %d articles', len(batch))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def write(self, batch: List[Tuple[AsyncIOMotorDatabase, dict, asyncio.Future]]) -> None:
+        """Writes a batch with one insert_many per database, a failing database never holds up the others"""
+        by_database = defaultdict(list)
+        for db, document, future in batch:
+            by_database[db.name].append((db, document, future))
+
+        for items in by_database.values():
+            error = None
+            try:
+                await self.write_database(items[0][0], items)
+            except Exception as exception:
+                logger.exception('Failed to write a batch of %d articles to %s', len(items), items[0][0].name)
+                error = exception
+            finally:
+                # Every caller gets an answer, even when the batch was cancelled or its bookkeeping failed
+                for _, _, future in items:
+                    if future.done():
+                        continue
+                    if error is None:
+                        future.cancel()
+                    else:
+                        future.set_exception(error)
+
+    async def write_database(self, db: AsyncIOMotorDatabase,
+                             items: List[Tuple[AsyncIOMotorDatabase, dict, asyncio.Future]]) -> None:
+        """Inserts the articles of one database and resolves each caller's future once its write is visible"""
+        collection = get_collection(db, 'articles', 'coalesced')
+        write_errors, concern_error = {}, None
+        try:
+            await collection.insert_many([document for _, document, _ in items], ordered=False)
+        except BulkWriteError as error:
+            write_errors = {write_error['index']: write_error for write_error in error.details['writeErrors']}
+            if error.details.get('writeConcernErrors'):
+                # The articles were written, but not as durably as configured
+                details = error.details['writeConcernErrors'][0]
+                concern_error = WriteConcernError(details['errmsg'], details.get('code'), details)
+
+        inserted = [document for position, (_, document, _) in enumerate(items) if position not in write_errors]
+        # Tag counts, caches and the search index are updated before any caller reads its own write
+        await articles_inserted(db, inserted, 'coalesced')
+
+        for position, (_, document, future) in enumerate(items):
+            # The caller may have gone away, e.g. when its request was cancelled
+            if future.done():
+                continue
+            if position in write_errors:
+                write_error = write_errors[position]
+                future.set_exception(WriteError(write_error['errmsg'], write_error['code'], write_error))
+            elif concern_error is not None:
+                future.set_exception(concern_error)
+            else:
+                future.set_result(document['_id'])
+
+    async def close(self) -> None:
+        """Writes every queued article, then stops the batching task"""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+
+
+insert_batcher = InsertBatcher(
+    enabled=settings.write_coalescing,
+    max_batch_size=settings.write_coalescing_batch_size,
+    max_delay=settings.write_coalescing_delay_ms / 1000,
+)
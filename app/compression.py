@@ -0,0 +1,192 @@
+import asyncio
+import time
+import zlib
+from typing import Dict, Optional, Tuple
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .config import settings
+from .metrics import COMPRESSION_SAVED_BYTES, COMPRESSION_SECONDS
+
+try:
+    import brotli
+except ImportError:  # br is only offered when the brotli package is installed
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # zstd is only offered when the zstandard package is installed
+    zstandard = None
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+
+class GzipEncoder:
+    def __init__(self):
+        self.compressor = zlib.compressobj(settings.compression_gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=settings.compression_brotli_quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.finish()
+
+
+class ZstdEncoder:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=settings.compression_zstd_level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+
+ENCODERS = {
+    'gzip': GzipEncoder,
+    **({'br': BrotliEncoder} if brotli is not None else {}),
+    **({'zstd': ZstdEncoder} if zstandard is not None else {}),
+}
+
+
+def negotiate(accept_encoding: str, preference: Tuple[str, ...]) -> Optional[str]:
+    """Picks the first encoding of preference which the client accepts, None if it accepts none of them"""
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.partition(';')
+        weight = 1.0
+        param, _, value = params.strip().partition('=')
+        if param.strip() == 'q':
+            try:
+                weight = float(value)
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    for encoding in preference:
+        if weights.get(encoding, weights.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+class CompressionMiddleware:
+    """Compresses responses with the best encoding the client accepts, once the body reaches minimum_size bytes.
+
+    Streamed responses are compressed chunk by chunk. Chunks of at least thread_threshold bytes are
+    compressed in the default thread pool, zlib, brotli and zstandard all release the GIL while compressing.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.preference = tuple(
+            encoding for encoding in settings.compression_encodings.split(',') if encoding in ENCODERS
+        )
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        encoding = None
+        if scope['type'] == 'http' and settings.compression:
+            encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''), self.preference)
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressionResponder(self.app, encoding)(scope, receive, send)
+
+
+class CompressionResponder:
+    def __init__(self, app: ASGIApp, encoding: str):
+        self.app = app
+        self.encoding = encoding
+        self.send = None
+        self.start: Optional[Message] = None
+        self.buffer = bytearray()
+        self.encoder = None
+        self.passthrough = False
+        self.input_size = 0
+        self.output_size = 0
+        self.seconds = 0.0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            # Held back until the body shows whether the response is worth compressing
+            self.start = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body, more_body = message.get('body', b''), message.get('more_body', False)
+        if self.encoder is None:
+            self.buffer += body
+            if more_body and len(self.buffer) < settings.compression_minimum_size:
+                return
+            body = bytes(self.buffer)
+            self.buffer.clear()
+            if not self.should_compress(body):
+                self.passthrough = True
+                await self.send(self.start)
+                await self.send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+                return
+            self.encoder = ENCODERS[self.encoding]()
+            compressed = await self.compress(body, finish=not more_body)
+            headers = MutableHeaders(raw=self.start['headers'])
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            etag = headers.get('etag')
+            if etag is not None and not etag.startswith('W/'):
+                # The compressed body is not byte for byte the one the strong ETag names
+                headers['ETag'] = f'W/{etag}'
+            if more_body:
+                del headers['Content-Length']
+            else:
+                headers['Content-Length'] = str(len(compressed))
+            await self.send(self.start)
+        else:
+            compressed = await self.compress(body, finish=not more_body)
+
+        if compressed or not more_body:
+            await self.send({'type': 'http.response.body', 'body': compressed, 'more_body': more_body})
+        if not more_body:
+            COMPRESSION_SAVED_BYTES.labels(self.encoding).inc(max(self.input_size - self.output_size, 0))
+            COMPRESSION_SECONDS.labels(self.encoding).observe(self.seconds)
+
+    def should_compress(self, body: bytes) -> bool:
+        headers = Headers(raw=self.start['headers'])
+        content_type = headers.get('content-type', '')
+        return (
+            len(body) >= settings.compression_minimum_size
+            and 'content-encoding' not in headers
+            and content_type.startswith(COMPRESSIBLE_TYPES)
+        )
+
+    async def compress(self, data: bytes, finish: bool) -> bytes:
+        if len(data) >= settings.compression_thread_threshold:
+            compressed, seconds = await asyncio.get_event_loop().run_in_executor(None, self.encode, data, finish)
+        else:
+            compressed, seconds = self.encode(data, finish)
+        self.input_size += len(data)
+        self.output_size += len(compressed)
+        self.seconds += seconds
+        return compressed
+
+    def encode(self, data: bytes, finish: bool) -> Tuple[bytes, float]:
+        """Compresses data and returns the CPU time it took, measured on the thread which did the work"""
+        started = time.thread_time()
+        compressed = self.encoder.compress(data)
+        if finish:
+            compressed += self.encoder.finish()
+        return compressed, time.thread_time() - started
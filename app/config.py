@@ -0,0 +1,165 @@
+from typing import Optional
+
+from motor.motor_asyncio import AsyncIOMotorCollection, AsyncIOMotorDatabase
+from pydantic import BaseSettings, Field, validator
+from pymongo.read_preferences import make_read_preference, read_pref_mode_from_name
+from pymongo.write_concern import WriteConcern
+
+# Operation types which can have their own read preference or write concern
+READ_OPERATIONS = ('list', 'single')
+WRITE_OPERATIONS = ('writes', 'bulk', 'coalesced')
+READ_PREFERENCE_MODES = ('primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest')
+COMPRESSORS = ('zstd', 'snappy', 'zlib')
+
+
+class Settings(BaseSettings):
+    """Application settings, read once from the environment and the .env file at import time"""
+
+    mongo_initdb_root_username: str = ''
+    mongo_initdb_root_password: str = ''
+    mongo_host: str = 'localhost'
+    mongo_port: int = 27017
+
+    # Connection pool, timeouts and wire compression of the Motor client
+    mongo_max_pool_size: int = 100
+    mongo_min_pool_size: int = 0
+    mongo_max_idle_time_ms: Optional[int] = None
+    mongo_wait_queue_timeout_ms: Optional[int] = None
+    mongo_server_selection_timeout_ms: int = 30000
+    mongo_connect_timeout_ms: int = 20000
+    mongo_socket_timeout_ms: Optional[int] = None
+    mongo_compressors: str = ''
+    mongo_zlib_compression_level: Optional[int] = None
+
+    # Read preference per read operation type, list endpoints tolerate reading from a lagging secondary
+    read_preference_list: str = 'primary'
+    read_preference_single: str = 'primary'
+
+    # Write concern per write operation type, w is a number of nodes or 'majority'
+    write_concern_writes_w: Optional[str] = None
+    write_concern_writes_j: Optional[bool] = None
+    write_concern_bulk_w: Optional[str] = None
+    write_concern_bulk_j: Optional[bool] = None
+    write_concern_coalesced_w: Optional[str] = Field('1', env='WRITE_COALESCING_W')
+    write_concern_coalesced_j: Optional[bool] = Field(None, env='WRITE_COALESCING_J')
+    write_concern_wtimeout_ms: Optional[int] = None
+
+    write_coalescing: bool = False
+    write_coalescing_batch_size: int = 100
+    write_coalescing_delay_ms: float = 5
+
+    cache_maxsize: int = 1024
+    cache_ttl: float = 60
+    cache_poll_interval: float = 5
+    warmup_caches: bool = True
+
+    # Response compression, br and zstd are only offered when brotli and zstandard are installed
+    compression: bool = True
+    compression_encodings: str = 'zstd,br,gzip'
+    compression_minimum_size: int = 1024
+    compression_thread_threshold: int = 64 * 1024
+    compression_gzip_level: int = 6
+    compression_brotli_quality: int = 4
+    compression_zstd_level: int = 3
+
+    # Requests without a tenant use default_database, other tenants must be listed in tenants
+    default_database: str = 'articles'
+    tenants: str = ''
+    tenant_header: str = 'X-Tenant'
+    tenant_path_prefix: str = '/tenants'
+    tenant_database_prefix: str = 'articles_'
+    tenant_concurrency: int = 32
+    tenant_queue: int = 128
+    tenant_timeout: float = 2.0
+
+    # Background jobs pause between batches to leave the pool to foreground requests
+    job_batch_size: int = 500
+    job_batch_delay_ms: float = 50
+    # Running jobs not updated for this long belong to a worker which died, and are queued again
+    job_stale_after: float = 300
+
+    search_backend: str = 'auto'
+    search_index_ttl: float = 300
+    tag_index_ttl: float = 60
+
+    # Admission control per route class, a concurrency of 0 disables the limit
+    admission_reads_concurrency: int = 64
+    admission_reads_queue: int = 256
+    admission_reads_timeout: float = 2.0
+    admission_writes_concurrency: int = 32
+    admission_writes_queue: int = 128
+    admission_writes_timeout: float = 2.0
+    admission_bulk_concurrency: int = 4
+    admission_bulk_queue: int = 8
+    admission_bulk_timeout: float = 10.0
+    admission_admin_concurrency: int = 1
+    admission_admin_queue: int = 2
+    admission_admin_timeout: float = 10.0
+
+    class Config:
+        env_file = '.env'
+
+    @validator('read_preference_list', 'read_preference_single')
+    def check_read_preference(cls, mode: str) -> str:
+        if mode not in READ_PREFERENCE_MODES:
+            raise ValueError(f'must be one of {", ".join(READ_PREFERENCE_MODES)}')
+        return mode
+
+    @validator('mongo_compressors')
+    def check_compressors(cls, compressors: str) -> str:
+        unknown = set(filter(None, compressors.split(','))) - set(COMPRESSORS)
+        if unknown:
+            raise ValueError(f'unknown compressors: {", ".join(sorted(unknown))}')
+        return compressors
+
+    @validator('search_backend')
+    def check_search_backend(cls, backend: str) -> str:
+        if backend not in ('auto', 'text', 'memory'):
+            raise ValueError('must be one of auto, text, memory')
+        return backend
+
+    @property
+    def mongo_uri(self) -> str:
+        return (f'mongodb://{self.mongo_initdb_root_username}:{self.mongo_initdb_root_password}'
+                f'@{self.mongo_host}:{self.mongo_port}')
+
+    def client_options(self) -> dict:
+        """Keyword arguments of the Motor client, unset options keep the driver's defaults"""
+        options = {
+            'maxPoolSize': self.mongo_max_pool_size,
+            'minPoolSize': self.mongo_min_pool_size,
+            'maxIdleTimeMS': self.mongo_max_idle_time_ms,
+            'waitQueueTimeoutMS': self.mongo_wait_queue_timeout_ms,
+            'serverSelectionTimeoutMS': self.mongo_server_selection_timeout_ms,
+            'connectTimeoutMS': self.mongo_connect_timeout_ms,
+            'socketTimeoutMS': self.mongo_socket_timeout_ms,
+            'compressors': self.mongo_compressors or None,
+            'zlibCompressionLevel': self.mongo_zlib_compression_level,
+        }
+        return {name: value for name, value in options.items() if value is not None}
+
+    def read_preference(self, operation: str):
+        return make_read_preference(read_pref_mode_from_name(getattr(self, f'read_preference_{operation}')), None)
+
+    def write_concern(self, operation: str) -> WriteConcern:
+        w = getattr(self, f'write_concern_{operation}_w')
+        journal = getattr(self, f'write_concern_{operation}_j')
+        if w is None and journal is None:
+            # Leave it to the server's default write concern
+            return WriteConcern()
+        return WriteConcern(
+            w=int(w) if w is not None and w.isdigit() else w,
+            j=journal,
+            wtimeout=self.write_concern_wtimeout_ms,
+        )
+
+
+settings = Settings()
+
+
+def build_collection(db: AsyncIOMotorDatabase, name: str, operation: str) -> AsyncIOMotorCollection:
+    """Creates a collection handle using the read preference or write concern configured for an operation type"""
+    if operation in READ_OPERATIONS:
+        return db.get_collection(name, read_preference=settings.read_preference(operation))
+    assert operation in WRITE_OPERATIONS
+    return db.get_collection(name, write_concern=settings.write_concern(operation))
@@ -1,7 +1,18 @@
-import os
+import asyncio
 
-from dotenv import load_dotenv
-from motor.motor_asyncio import AsyncIOMotorClient
+from fastapi import Depends, HTTPException, Request
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+
+from .cache import invalidator
+from .coalescing import insert_batcher
+from .config import settings
+from .health import readiness
+from .indexes import ensure_indexes
+from .jobs import job_runner
+from .metrics import CommandMetrics, PoolMetrics
+from .search import get_search_index
+from .tags import get_tag_index
+from .tenants import DEFAULT_TENANT, Tenant, is_allowed, tenant_name, tenant_registry
 
 
 class DataBase:
@@ -12,26 +23,63 @@ db = DataBase()
 
 
 def get_mongo_uri() -> str:
-    """Load environment variables and create MongoDB URI"""
-    load_dotenv()
-    mongo_username = os.environ.get('MONGO_INITDB_ROOT_USERNAME')
-    mongo_password = os.environ.get('MONGO_INITDB_ROOT_PASSWORD')
-    mongo_host = os.environ.get('MONGO_HOST')
-    mongo_port = os.environ.get('MONGO_PORT')
-    mongo_uri = f'mongodb://{mongo_username}:{mongo_password}@{mongo_host}:{mongo_port}'
-    return mongo_uri
+    """Returns the MongoDB URI of the settings read at import time"""
+    return settings.mongo_uri
+
+
+async def prepare_tenant(database: AsyncIOMotorDatabase) -> None:
+    """Applies a tenant's indexes, resumes its jobs and starts invalidating its cached pages"""
+    await ensure_indexes(database)
+    await job_runner.resume(database)
+    await job_runner.migrate_tag_counts(database)
+    invalidator.start(database)
+
+
+async def get_tenant(request: Request) -> Tenant:
+    """Resolves the tenant of a request, unknown tenants are answered with 404"""
+    name = tenant_name(request)
+    if not is_allowed(name):
+        raise HTTPException(status_code=404, detail=f'Unknown tenant: {name}')
+    return await tenant_registry.get(db.client, name, prepare_tenant)
+
+
+async def get_database(tenant: Tenant = Depends(get_tenant)) -> AsyncIOMotorDatabase:
+    """Returns the asynchronous DB client of the request's tenant"""
+    return tenant.database
+
+
+async def open_pool(client: AsyncIOMotorClient) -> None:
+    """Opens minPoolSize connections up front, concurrent commands each check out their own connection"""
+    await asyncio.gather(*(client.admin.command('ping') for _ in range(settings.mongo_min_pool_size)))
 
 
-async def get_database(db_name: str = 'articles') -> AsyncIOMotorClient:
-    """Returns an asynchronous DB client"""
-    return db.client[db_name]
+async def warm_caches(database: AsyncIOMotorDatabase) -> None:
+    """Builds the in-memory indexes which would otherwise be built by the first request"""
+    await get_tag_index(database)
+    if settings.search_backend == 'memory':
+        await get_search_index(database)
 
 
 async def startup_db_client() -> None:
-    """Start DB client"""
-    db.client = AsyncIOMotorClient(get_mongo_uri())
+    """Start DB client and warm the worker up before it accepts requests"""
+    db.client = AsyncIOMotorClient(
+        get_mongo_uri(), event_listeners=[CommandMetrics(), PoolMetrics()], **settings.client_options(),
+    )
+    await readiness.stage('ping', db.client.admin.command('ping'))
+    await readiness.stage('pool', open_pool(db.client))
+    # Other tenants get their indexes when their first request arrives
+    tenant = await readiness.stage('indexes', tenant_registry.get(db.client, DEFAULT_TENANT, prepare_tenant))
+    database = tenant.database
+    if settings.warmup_caches:
+        await readiness.stage('caches', warm_caches(database), required=False)
+    readiness.mark_ready()
 
 
 async def shutdown_db_client() -> None:
-    """Shutdown DB client"""
+    """Write queued articles, interrupt background jobs and shutdown DB client"""
+    readiness.mark_stopping()
+    await insert_batcher.close()
+    await job_runner.close()
+    await invalidator.stop()
+    tenant_registry.clear()
     db.client.close()
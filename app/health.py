@@ -0,0 +1,54 @@
+import logging
+import time
+from typing import Any, Awaitable, Dict, Optional
+
+from . import IMPORTED_AT
+from .metrics import STARTUP_SECONDS, STARTUP_STAGE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """Tracks the warm-up stages of this worker, it is ready once every required stage succeeded"""
+
+    def __init__(self):
+        self.stages: Dict[str, dict] = {}
+        self.required: Dict[str, bool] = {}
+        self.ready_after: Optional[float] = None
+
+    async def stage(self, name: str, awaitable: Awaitable, required: bool = True) -> Any:
+        """Runs a warm-up stage and returns its result, a failed optional stage is logged and startup carries on"""
+        self.required[name] = required
+        self.stages[name] = {'status': 'running'}
+        started = time.monotonic()
+        try:
+            result = await awaitable
+        except Exception as error:
+            self.stages[name] = {'status': 'failed', 'seconds': time.monotonic() - started, 'error': str(error)}
+            if required:
+                raise
+            logger.exception('Warm-up stage %s failed', name)
+            return None
+        self.stages[name] = {'status': 'ok', 'seconds': time.monotonic() - started}
+        STARTUP_STAGE_SECONDS.labels(name).set(self.stages[name]['seconds'])
+        return result
+
+    def mark_ready(self) -> None:
+        self.ready_after = time.monotonic() - IMPORTED_AT
+        STARTUP_SECONDS.set(self.ready_after)
+        logger.info('Worker ready %.2fs after import', self.ready_after)
+
+    def mark_stopping(self) -> None:
+        self.ready_after = None
+
+    @property
+    def ready(self) -> bool:
+        return self.ready_after is not None and all(
+            stage['status'] == 'ok' for name, stage in self.stages.items() if self.required[name]
+        )
+
+    def report(self) -> dict:
+        return {'ready': self.ready, 'import_to_ready_seconds': self.ready_after, 'stages': self.stages}
+
+
+readiness = Readiness()
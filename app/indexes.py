@@ -0,0 +1,73 @@
+from typing import Dict, List, Set
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING, DESCENDING, TEXT, IndexModel
+
+# Indexes for every collection, applied idempotently on startup
+INDEXES: Dict[str, List[dict]] = {
+    'articles': [
+        # Multikey index serving tag lookups sorted by _id, per-tag counts and distinct('tags')
+        {'keys': [('tags', ASCENDING), ('_id', ASCENDING)], 'name': 'tags_id'},
+        # Full-text search over content, ranked by textScore
+        {'keys': [('content', TEXT)], 'name': 'content_text'},
+    ],
+    'tags': [
+        # Tag counts sorted by popularity, sorting by name uses the _id index
+        {'keys': [('count', DESCENDING), ('_id', ASCENDING)], 'name': 'count_id'},
+    ],
+}
+
+# Explain commands for the hot queries in views.py, each should be served by an index
+HOT_QUERIES: Dict[str, dict] = {
+    'get_single_article': {'find': 'articles', 'filter': {'_id': ObjectId()}},
+    'get_all_articles': {'find': 'articles', 'filter': {}, 'sort': {'_id': 1}, 'limit': 101},
+    'get_all_articles_with_tag': {
+        'find': 'articles',
+        'filter': {'tags': {'$elemMatch': {'$eq': 'tag'}}},
+        'sort': {'_id': 1},
+        'limit': 101,
+    },
+    'query_articles': {
+        'find': 'articles',
+        'filter': {'tags': {'$all': ['tag'], '$in': ['tag', 'other']}},
+        'sort': {'_id': 1},
+        'limit': 101,
+    },
+    'count_articles_with_tag': {'count': 'articles', 'query': {'tags': 'tag'}},
+    'get_all_tags': {'find': 'tags', 'filter': {}, 'sort': {'_id': 1}},
+    'get_all_tags_by_popularity': {'find': 'tags', 'filter': {}, 'sort': {'count': -1, '_id': 1}},
+}
+
+
+def index_models(collection: str, background: bool = False) -> List[IndexModel]:
+    """Builds the IndexModels registered for a collection"""
+    return [
+        IndexModel(spec['keys'], background=background, **{k: v for k, v in spec.items() if k != 'keys'})
+        for spec in INDEXES.get(collection, [])
+    ]
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase, background: bool = False) -> None:
+    """Creates every registered index, indexes which already exist are left untouched"""
+    for collection in INDEXES:
+        await db[collection].create_indexes(index_models(collection, background=background))
+
+
+def plan_stages(plan) -> Set[str]:
+    """Collects every stage name found in an explain plan"""
+    if isinstance(plan, list):
+        return set().union(*(plan_stages(item) for item in plan))
+    if not isinstance(plan, dict):
+        return set()
+    stages = {plan['stage']} if 'stage' in plan else set()
+    return stages.union(*(plan_stages(value) for value in plan.values()))
+
+
+async def explain_hot_queries(db: AsyncIOMotorDatabase) -> Dict[str, Set[str]]:
+    """Returns the winning plan stages of every hot query"""
+    report = {}
+    for name, command in HOT_QUERIES.items():
+        explain = await db.command({'explain': command, 'verbosity': 'queryPlanner'})
+        report[name] = plan_stages(explain['queryPlanner']['winningPlan'])
+    return report
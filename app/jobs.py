@@ -0,0 +1,220 @@
+import asyncio
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ASCENDING
+
+from .cache import invalidate_database
+from .config import settings
+from .indexes import ensure_indexes
+from .models import Job
+from .search import drop_search_index, remove_article
+from .tags import apply_tag_delta, drop_tag_index, rebuild_tag_counts, tag_delta, tag_query
+from .tenants import get_collection
+
+logger = logging.getLogger(__name__)
+
+
+def job_output(job: dict) -> dict:
+    return {
+        'id': str(job['_id']),
+        **{key: value for key, value in job.items() if key != '_id'},
+    }
+
+
+class JobRunner:
+    """Runs background jobs one at a time, in throttled batches so foreground requests keep their latency.
+
+    Jobs and their progress are stored in the jobs collection, so any worker can report on a job run by another.
+    Every job restarts safely from its query, jobs cut short by a shutdown or a dead worker are queued again.
+    Job documents are written with the writes write concern and articles with the bulk one, reads go to the primary.
+    """
+
+    def __init__(self, batch_size: int, batch_delay: float, stale_after: float):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.stale_after = stale_after
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+
+    async def submit(self, db: AsyncIOMotorDatabase, job: Job) -> dict:
+        """Stores a job as queued and schedules it on this worker"""
+        document = {
+            '_id': ObjectId(),
+            'type': job.type,
+            'params': job.dict(by_alias=True, exclude={'type'}, exclude_defaults=True),
+            'status': 'queued',
+            'processed': 0,
+            'total': None,
+            'error': None,
+            'created_at': datetime.utcnow(),
+            'updated_at': datetime.utcnow(),
+            'started_at': None,
+            'finished_at': None,
+        }
+        await get_collection(db, 'jobs', 'writes').insert_one(document)
+        await self.enqueue(db, document['_id'], job)
+        return document
+
+    async def resume(self, db: AsyncIOMotorDatabase) -> int:
+        """Schedules the jobs left queued by workers which stopped, returns how many were found.
+
+        Jobs still running without an update for stale_after seconds are taken over from their dead worker.
+        """
+        await get_collection(db, 'jobs', 'writes').update_many(
+            {'status': 'running', 'updated_at': {'$lt': datetime.utcnow() - timedelta(seconds=self.stale_after)}},
+            {'$set': {'status': 'queued', 'updated_at': datetime.utcnow()}},
+        )
+        jobs = await db['jobs'].find({'status': 'queued'}).sort('_id', ASCENDING).to_list(length=None)
+        for document in jobs:
+            await self.enqueue(db, document['_id'], Job(type=document['type'], **document['params']))
+        return len(jobs)
+
+    async def migrate_tag_counts(self, db: AsyncIOMotorDatabase) -> Optional[dict]:
+        """Queues a rebuild of the tag counts once per database, when its articles predate the tags collection"""
+        # The first worker to record the migration queues it, later databases start with their counts up to date
+        marker = await get_collection(db, 'migrations', 'writes').update_one(
+            {'_id': 'tag_counts'}, {'$setOnInsert': {'created_at': datetime.utcnow()}}, upsert=True,
+        )
+        if marker.upserted_id is None or not await db['articles'].estimated_document_count():
+            return None
+        return await self.submit(db, Job(type='rebuild_tags'))
+
+    async def enqueue(self, db: AsyncIOMotorDatabase, job_id: ObjectId, job: Job) -> None:
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.ensure_future(self.run())
+        await self.queue.put((db, job_id, job))
+
+    async def run(self) -> None:
+        while True:
+            db, job_id, job = await self.queue.get()
+            try:
+                await self.execute(db, job_id, job)
+            finally:
+                self.queue.task_done()
+
+    async def execute(self, db: AsyncIOMotorDatabase, job_id: ObjectId, job: Job) -> None:
+        # Resumed jobs may be scheduled by several workers, only the first to claim one runs it
+        claimed = await get_collection(db, 'jobs', 'writes').update_one(
+            {'_id': job_id, 'status': 'queued'},
+            {'$set': {'status': 'running', 'started_at': datetime.utcnow(), 'updated_at': datetime.utcnow()}},
+        )
+        if not claimed.modified_count:
+            return
+        try:
+            if job.type == 'rename_tag':
+                await self.rename_tag(db, job_id, job.source, job.target)
+            elif job.type == 'delete_articles':
+                await self.delete_articles(db, job_id, tag_query(job.all_tags, job.any_tags, job.no_tags))
+            elif job.type == 'rebuild_tags':
+                await self.rebuild_tags(db, job_id)
+            else:
+                await self.delete_all(db, job_id)
+        except asyncio.CancelledError:
+            # Picked up again by resume, batches restart from the job's query
+            await self.update(db, job_id, status='queued')
+            raise
+        except Exception as error:
+            logger.exception('Job %s failed', job_id)
+            await self.update(db, job_id, status='failed', error=str(error), finished_at=datetime.utcnow())
+        else:
+            await self.update(db, job_id, status='succeeded', finished_at=datetime.utcnow())
+
+    async def update(self, db: AsyncIOMotorDatabase, job_id: ObjectId, **fields) -> None:
+        await get_collection(db, 'jobs', 'writes').update_one(
+            {'_id': job_id}, {'$set': {**fields, 'updated_at': datetime.utcnow()}},
+        )
+
+    async def batches(self, db: AsyncIOMotorDatabase, job_id: ObjectId, query: dict) -> AsyncIterator[List[dict]]:
+        """Yields the ids and tags of matching articles in batches, recording progress and pausing between them"""
+        await self.update(db, job_id, total=await db['articles'].count_documents(query))
+        processed = 0
+        after = {}
+        while True:
+            cursor = db['articles'].find({**query, **after}, {'tags': True}).sort('_id', ASCENDING)
+            articles = await cursor.limit(self.batch_size).to_list(length=self.batch_size)
+            if not articles:
+                return
+            yield articles
+            after = {'_id': {'$gt': articles[-1]['_id']}}
+            processed += len(articles)
+            await self.update(db, job_id, processed=processed)
+            await asyncio.sleep(self.batch_delay)
+
+    async def rename_tag(self, db: AsyncIOMotorDatabase, job_id: ObjectId, source: str, target: str) -> None:
+        """Renames source to target, merging it into target on articles which already have both tags"""
+        async for articles in self.batches(db, job_id, {'tags': source}):
+            ids = [article['_id'] for article in articles]
+            # Counts follow each write, so a failure or shutdown between them leaves no drift
+            merged = await get_collection(db, 'articles', 'bulk').update_many(
+                {'_id': {'$in': ids}, 'tags': {'$all': [source, target]}},
+                {'$pull': {'tags': source}, '$inc': {'version': 1}},
+            )
+            await apply_tag_delta(db, Counter({source: -merged.modified_count}), 'bulk')
+            renamed = await get_collection(db, 'articles', 'bulk').update_many(
+                {'_id': {'$in': ids}, 'tags': source},
+                {'$set': {'tags.$[tag]': target}, '$inc': {'version': 1}},
+                array_filters=[{'tag': source}],
+            )
+            delta = Counter({source: -renamed.modified_count, target: renamed.modified_count})
+            await apply_tag_delta(db, delta, 'bulk')
+            await self.articles_changed(db)
+
+    async def delete_articles(self, db: AsyncIOMotorDatabase, job_id: ObjectId, query: dict) -> None:
+        """Deletes matching articles one by one, so tag counts follow exactly what was deleted"""
+        async for articles in self.batches(db, job_id, query):
+            delta = Counter()
+            for article in articles:
+                # Articles re-tagged or deleted since the batch was read are left alone and not counted
+                deleted = await get_collection(db, 'articles', 'bulk').find_one_and_delete(
+                    {**query, '_id': article['_id']}, projection={'tags': True},
+                )
+                if deleted is not None:
+                    delta.update(tag_delta(old_tags=deleted['tags']))
+                    remove_article(db, str(deleted['_id']))
+            await apply_tag_delta(db, delta, 'bulk')
+            await invalidate_database(db)
+
+    async def delete_all(self, db: AsyncIOMotorDatabase, job_id: ObjectId) -> None:
+        """Drops and recreates the collections, which is far cheaper than deleting every document"""
+        total = await db['articles'].estimated_document_count()
+        await self.update(db, job_id, total=total)
+        await get_collection(db, 'articles', 'bulk').drop()
+        await get_collection(db, 'tags', 'bulk').drop()
+        await ensure_indexes(db)
+        await self.articles_changed(db)
+        drop_tag_index(db)
+        await self.update(db, job_id, processed=total)
+
+    async def rebuild_tags(self, db: AsyncIOMotorDatabase, job_id: ObjectId) -> None:
+        total = await db['articles'].estimated_document_count()
+        await self.update(db, job_id, total=total)
+        await rebuild_tag_counts(db)
+        await self.update(db, job_id, processed=total)
+
+    async def articles_changed(self, db: AsyncIOMotorDatabase) -> None:
+        """Drops cached pages and the search index after a batch changed tags of arbitrary articles"""
+        await invalidate_database(db)
+        drop_search_index(db)
+
+    async def close(self) -> None:
+        """Stops the running job and queues it again, queued jobs are resumed by the next worker to start"""
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+
+job_runner = JobRunner(
+    batch_size=settings.job_batch_size,
+    batch_delay=settings.job_batch_delay_ms / 1000,
+    stale_after=settings.job_stale_after,
+)
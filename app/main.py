@@ -1,10 +1,35 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from fastapi.responses import JSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST
 
-from .database import startup_db_client, shutdown_db_client, os
+from .compression import CompressionMiddleware
+from .database import startup_db_client, shutdown_db_client
+from .health import readiness
+from .metrics import MetricsMiddleware, generate_metrics
+from .tenants import TenantPathMiddleware
 from .views import router
 
 # Initialize FastAPI
 app = FastAPI()
 app.include_router(router=router, prefix='/v1')
+# The last middleware added runs first, latency metrics include compression
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TenantPathMiddleware)
 app.add_event_handler('startup', startup_db_client)
 app.add_event_handler('shutdown', shutdown_db_client)
+
+
+@app.get('/metrics', include_in_schema=False)
+def metrics():
+    return Response(generate_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get('/health/live', include_in_schema=False)
+def liveness():
+    return {'status': 'alive'}
+
+
+@app.get('/health/ready', include_in_schema=False)
+def readiness_check():
+    return JSONResponse(status_code=200 if readiness.ready else 503, content=readiness.report())
@@ -0,0 +1,60 @@
+"""Admin commands, run with: python -m app.manage <command>"""
+import argparse
+import asyncio
+import sys
+
+from .database import AsyncIOMotorClient, get_mongo_uri
+from .indexes import ensure_indexes, explain_hot_queries
+from .tags import rebuild_tag_counts
+
+
+async def build_indexes(db) -> int:
+    """Builds every registered index in the background, e.g. before a deploy"""
+    await ensure_indexes(db, background=True)
+    print('Indexes built')
+    return 0
+
+
+async def check_indexes(db) -> int:
+    """Explains every hot query and fails if any of them scans the whole collection"""
+    exit_code = 0
+    for name, stages in (await explain_hot_queries(db)).items():
+        status = 'COLLSCAN' if 'COLLSCAN' in stages else 'OK'
+        if status != 'OK':
+            exit_code = 1
+        print(f'{status:<8} {name}: {", ".join(sorted(stages))}')
+    return exit_code
+
+
+async def rebuild_tags(db) -> int:
+    """Recomputes the per-tag article counts from the articles collection"""
+    print(f'Rebuilt counts for {await rebuild_tag_counts(db)} tags')
+    return 0
+
+
+COMMANDS = {
+    'build-indexes': build_indexes,
+    'check-indexes': check_indexes,
+    'rebuild-tags': rebuild_tags,
+}
+
+
+async def run(command: str, db_name: str) -> int:
+    """Runs a single admin command against a database"""
+    client = AsyncIOMotorClient(get_mongo_uri())
+    try:
+        return await COMMANDS[command](client[db_name])
+    finally:
+        client.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m app.manage')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('--db', default='articles', help='database name (default: articles)')
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run(args.command, args.db)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import threading
+import time
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from pymongo import monitoring
+from starlette.routing import Match
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .cache import article_cache
+
+# Gauges are summed across live gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set
+REQUEST_LATENCY = Histogram(
+    'http_request_duration_seconds', 'Time until the response body has been sent', ['method', 'route', 'status'],
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'http_requests_in_flight', 'Requests currently being handled', ['method', 'route'], multiprocess_mode='livesum',
+)
+MONGO_COMMAND_DURATION = Histogram(
+    'mongo_command_duration_seconds', 'MongoDB command round trip time', ['command', 'status'],
+)
+MONGO_POOL_CHECKOUT_WAIT = Histogram(
+    'mongo_pool_checkout_wait_seconds', 'Time spent waiting for a connection from the pool', ['status'],
+)
+MONGO_POOL_CONNECTIONS = Gauge(
+    'mongo_pool_connections', 'Open connections in the pool', ['address'], multiprocess_mode='livesum',
+)
+MONGO_POOL_CHECKED_OUT = Gauge(
+    'mongo_pool_checked_out_connections', 'Connections currently checked out of the pool', ['address'],
+    multiprocess_mode='livesum',
+)
+CACHE_EVENTS = Counter('article_cache_events_total', 'Article cache hits, misses, evictions and expirations', ['event'])
+CACHE_SIZE = Gauge('article_cache_entries', 'Entries in the article cache', multiprocess_mode='livesum')
+
+ADMISSION_WAIT = Histogram(
+    'admission_wait_seconds', 'Time requests waited in the admission queue of their route class', ['route_class'],
+)
+ADMISSION_REJECTED = Counter(
+    'admission_rejected_total', 'Requests answered with 503 by admission control', ['route_class', 'reason'],
+)
+TENANT_REQUESTS = Counter('tenant_requests_total', 'Requests admitted per tenant', ['tenant', 'route_class'])
+TENANT_REJECTED = Counter(
+    'tenant_rejected_total', 'Requests answered with 503 because their tenant used up its quota', ['tenant', 'reason'],
+)
+
+COMPRESSION_SAVED_BYTES = Counter(
+    'http_response_compression_saved_bytes_total', 'Bytes saved by compressing response bodies', ['encoding'],
+)
+COMPRESSION_SECONDS = Histogram(
+    'http_response_compression_seconds', 'CPU time spent compressing each response body', ['encoding'],
+)
+STARTUP_SECONDS = Gauge(
+    'app_import_to_ready_seconds', 'Time from importing the app until the worker was warm', multiprocess_mode='liveall',
+)
+STARTUP_STAGE_SECONDS = Gauge(
+    'app_startup_stage_seconds', 'Duration of each warm-up stage', ['stage'], multiprocess_mode='liveall',
+)
+
+CACHE_EVENT_NAMES = ('hits', 'misses', 'evictions', 'expirations')
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Records the duration of every MongoDB command"""
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        MONGO_COMMAND_DURATION.labels(event.command_name, 'succeeded').observe(event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        MONGO_COMMAND_DURATION.labels(event.command_name, 'failed').observe(event.duration_micros / 1e6)
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Records pool sizes and how long operations wait to check out a connection.
+
+    Motor runs PyMongo in a thread pool, a check out starts and completes on the same thread.
+    """
+
+    def __init__(self):
+        self.checkouts = threading.local()
+
+    def _address(self, event) -> str:
+        return '%s:%s' % event.address
+
+    def pool_created(self, event) -> None:
+        pass
+
+    def pool_cleared(self, event) -> None:
+        pass
+
+    def pool_closed(self, event) -> None:
+        MONGO_POOL_CONNECTIONS.labels(self._address(event)).set(0)
+        MONGO_POOL_CHECKED_OUT.labels(self._address(event)).set(0)
+
+    def connection_created(self, event) -> None:
+        MONGO_POOL_CONNECTIONS.labels(self._address(event)).inc()
+
+    def connection_ready(self, event) -> None:
+        pass
+
+    def connection_closed(self, event) -> None:
+        MONGO_POOL_CONNECTIONS.labels(self._address(event)).dec()
+
+    def connection_check_out_started(self, event) -> None:
+        self.checkouts.started = time.perf_counter()
+
+    def connection_check_out_failed(self, event) -> None:
+        self._observe_wait('failed')
+
+    def connection_checked_out(self, event) -> None:
+        self._observe_wait('succeeded')
+        MONGO_POOL_CHECKED_OUT.labels(self._address(event)).inc()
+
+    def connection_checked_in(self, event) -> None:
+        MONGO_POOL_CHECKED_OUT.labels(self._address(event)).dec()
+
+    def _observe_wait(self, status: str) -> None:
+        started = getattr(self.checkouts, 'started', None)
+        if started is not None:
+            MONGO_POOL_CHECKOUT_WAIT.labels(status).observe(time.perf_counter() - started)
+            self.checkouts.started = None
+
+
+class MetricsMiddleware:
+    """Records per-route latency histograms and in-flight requests.
+
+    Routes are labelled by their path template, e.g. /v1/article/{id}, to keep label cardinality bounded.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.cache_stats = dict.fromkeys(CACHE_EVENT_NAMES, 0)
+
+    def route_name(self, scope: Scope) -> str:
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        method, route, status = scope['method'], self.route_name(scope), 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        started = time.perf_counter()
+        REQUESTS_IN_FLIGHT.labels(method, route).inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.labels(method, route).dec()
+            REQUEST_LATENCY.labels(method, route, status).observe(time.perf_counter() - started)
+            self.record_cache_stats()
+
+    def record_cache_stats(self) -> None:
+        """Turns the cache's own counters into Prometheus counters"""
+        stats = article_cache.stats()
+        for event in CACHE_EVENT_NAMES:
+            if stats[event] != self.cache_stats[event]:
+                CACHE_EVENTS.labels(event).inc(max(stats[event] - self.cache_stats[event], 0))
+                self.cache_stats[event] = stats[event]
+        CACHE_SIZE.set(stats['size'])
+
+
+def generate_metrics() -> bytes:
+    """Renders every metric, aggregated across gunicorn workers when PROMETHEUS_MULTIPROC_DIR is set"""
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
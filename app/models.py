@@ -1,5 +1,14 @@
-from pydantic import BaseModel, validator
-from typing import List
+from pydantic import BaseModel, Field, root_validator, validator
+from typing import List, Optional
+
+JOB_TYPES = ('rename_tag', 'delete_articles', 'delete_all', 'rebuild_tags')
+
+
+def clean_tag(tag: str) -> str:
+    """Check a tag for invalid characters and convert to lowercase"""
+    invalid_chars = ['?', '/']
+    assert not any(char in tag for char in invalid_chars), f'Invalid character found in tag: {invalid_chars}'
+    return tag.lower()
 
 
 class Article(BaseModel):
@@ -9,12 +18,43 @@ class Article(BaseModel):
     @validator('tags', each_item=True)
     def check_invalid_tag(cls, tag):
         """Check each tag for invalid characters and convert to lowercase"""
-        invalid_chars = ['?', '/']
-        assert not any(char in tag for char in invalid_chars), f'Invalid character found in tag: {invalid_chars}'
-        return tag.lower()
+        return clean_tag(tag)
 
     @validator('tags')
     def remove_duplicates(cls, tags):
         if len(tags) > 1:
             return list({tag: 0 for tag in tags})
         return tags
+
+
+class Job(BaseModel):
+    """A background job: rename or merge a tag, delete articles by tag query or all of them, or recount the tags"""
+    type: str
+    source: Optional[str] = None
+    target: Optional[str] = None
+    all_tags: List[str] = Field([], alias='all')
+    any_tags: List[str] = Field([], alias='any')
+    no_tags: List[str] = Field([], alias='none')
+
+    @validator('type')
+    def check_type(cls, type):
+        assert type in JOB_TYPES, f'Job type must be one of: {", ".join(JOB_TYPES)}'
+        return type
+
+    @validator('source', 'target')
+    def check_tag(cls, tag):
+        return clean_tag(tag) if tag is not None else tag
+
+    @validator('all_tags', 'any_tags', 'no_tags', each_item=True)
+    def check_tags(cls, tag):
+        return clean_tag(tag)
+
+    @root_validator(skip_on_failure=True)
+    def check_parameters(cls, values):
+        if values['type'] == 'rename_tag':
+            assert values['source'] and values['target'], 'rename_tag requires a source and a target tag'
+            assert values['source'] != values['target'], 'source and target tags must differ'
+        if values['type'] == 'delete_articles':
+            assert values['all_tags'] or values['any_tags'] or values['no_tags'], \
+                'delete_articles requires at least one of all, any or none'
+        return values
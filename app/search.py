@@ -0,0 +1,93 @@
+import math
+import re
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from .cache import DatabaseIndexes
+from .config import settings
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class InMemorySearchIndex:
+    """Inverted index over article content, ranked by tf-idf.
+
+    Stand-in for a MongoDB text index on deployments which don't have one. Only ids,
+    term frequencies and tags are kept in memory, matching articles are fetched from MongoDB.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[str, int]] = {}
+        self.terms: Dict[str, Counter] = {}
+        self.tags: Dict[str, frozenset] = {}
+
+    def add(self, article_id: str, content: str, tags: Iterable[str]) -> None:
+        """Indexes an article, replacing any previous version of it"""
+        self.remove(article_id)
+        terms = Counter(tokenize(content))
+        for term, frequency in terms.items():
+            self.postings.setdefault(term, {})[article_id] = frequency
+        self.terms[article_id] = terms
+        self.tags[article_id] = frozenset(tags)
+
+    def remove(self, article_id: str) -> None:
+        for term in self.terms.pop(article_id, ()):
+            postings = self.postings[term]
+            del postings[article_id]
+            if not postings:
+                del self.postings[term]
+        self.tags.pop(article_id, None)
+
+    def search(self, query: str, tags: Iterable[str] = ()) -> List[Tuple[str, float]]:
+        """Returns (article id, score) for articles matching any query term and all tags, best first"""
+        tags = set(tags)
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, {})
+            if not postings:
+                continue
+            idf = math.log(1 + len(self.terms) / len(postings))
+            for article_id, frequency in postings.items():
+                if tags <= self.tags[article_id]:
+                    scores[article_id] += frequency * idf
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+
+async def build_search_index(db: AsyncIOMotorDatabase) -> InMemorySearchIndex:
+    index = InMemorySearchIndex()
+    async for article in db['articles'].find({}, {'content': True, 'tags': True}).batch_size(1000):
+        index.add(str(article['_id']), article['content'], article.get('tags', []))
+    return index
+
+
+search_indexes = DatabaseIndexes(build_search_index, ttl=lambda: settings.search_index_ttl)
+
+
+async def get_search_index(db: AsyncIOMotorDatabase) -> InMemorySearchIndex:
+    """Returns the in-memory search index of a database, building it when missing or older than its TTL"""
+    return await search_indexes.get(db)
+
+
+def index_article(db: AsyncIOMotorDatabase, article_id: str, content: str, tags: Iterable[str]) -> None:
+    """Adds or replaces an article in the in-memory index, if it has been built"""
+    index = search_indexes.loaded(db)
+    if index is not None:
+        index.add(article_id, content, tags)
+
+
+def remove_article(db: AsyncIOMotorDatabase, article_id: str) -> None:
+    """Removes an article from the in-memory index, if it has been built"""
+    index = search_indexes.loaded(db)
+    if index is not None:
+        index.remove(article_id)
+
+
+def drop_search_index(db: AsyncIOMotorDatabase) -> None:
+    """Drops the in-memory index, it is rebuilt on the next search"""
+    search_indexes.drop(db)
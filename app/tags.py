@@ -0,0 +1,110 @@
+from bisect import bisect_left, insort
+from collections import Counter
+from typing import Dict, Iterable, List, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from .cache import DatabaseIndexes
+from .config import settings
+from .tenants import get_collection
+
+
+def tag_delta(old_tags: Iterable[str] = (), new_tags: Iterable[str] = ()) -> Counter:
+    """Returns the change in article count per tag when an article's tags go from old_tags to new_tags"""
+    delta = Counter(set(new_tags))
+    delta.subtract(set(old_tags))
+    return Counter({tag: change for tag, change in delta.items() if change})
+
+
+def tag_query(all_tags: List[str], any_tags: List[str], no_tags: List[str]) -> dict:
+    """Builds a query matching articles with all of, any of and none of the given tags"""
+    tags = {}
+    if all_tags:
+        tags['$all'] = all_tags
+    if any_tags:
+        tags['$in'] = any_tags
+    if no_tags:
+        tags['$nin'] = no_tags
+    return {'tags': tags} if tags else {}
+
+
+async def apply_tag_delta(db: AsyncIOMotorDatabase, delta: Counter, operation: str = 'writes') -> None:
+    """Applies tag count changes to the tags collection and drops tags which are no longer used.
+
+    Counts are written with the write concern of the operation type which changed the articles.
+    """
+    if not delta:
+        return
+    tags = get_collection(db, 'tags', operation)
+    await tags.bulk_write(
+        [UpdateOne({'_id': tag}, {'$inc': {'count': change}}, upsert=True) for tag, change in delta.items()],
+        ordered=False,
+    )
+    decremented = [tag for tag, change in delta.items() if change < 0]
+    if decremented:
+        await tags.delete_many({'_id': {'$in': decremented}, 'count': {'$lte': 0}})
+    index = tag_indexes.loaded(db)
+    if index is not None:
+        index.apply(delta)
+
+
+async def rebuild_tag_counts(db: AsyncIOMotorDatabase) -> int:
+    """Recomputes the tags collection from the articles collection and returns the number of tags"""
+    pipeline = [
+        {'$project': {'tags': {'$setUnion': ['$tags', []]}}},
+        {'$unwind': '$tags'},
+        {'$group': {'_id': '$tags', 'count': {'$sum': 1}}},
+        {'$out': 'tags'},
+    ]
+    await db['articles'].aggregate(pipeline).to_list(length=None)
+    drop_tag_index(db)
+    return await db['tags'].count_documents({})
+
+
+
+class TagIndex:
+    """Sorted array of tag names with their article counts, for prefix lookups in O(log n + k)"""
+
+    def __init__(self, counts: Dict[str, int]):
+        self.counts = {tag: count for tag, count in counts.items() if count > 0}
+        self.names = sorted(self.counts)
+
+    def apply(self, delta: Counter) -> None:
+        """Applies tag count changes, adding new tags and removing tags which are no longer used"""
+        for tag, change in delta.items():
+            count = self.counts.get(tag, 0) + change
+            if count > 0:
+                if tag not in self.counts:
+                    insort(self.names, tag)
+                self.counts[tag] = count
+            elif tag in self.counts:
+                del self.counts[tag]
+                del self.names[bisect_left(self.names, tag)]
+
+    def suggest(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        """Returns up to limit (tag, count) pairs starting with prefix, in name order"""
+        suggestions = []
+        for position in range(bisect_left(self.names, prefix), len(self.names)):
+            tag = self.names[position]
+            if len(suggestions) == limit or not tag.startswith(prefix):
+                break
+            suggestions.append((tag, self.counts[tag]))
+        return suggestions
+
+
+async def build_tag_index(db: AsyncIOMotorDatabase) -> TagIndex:
+    return TagIndex({tag['_id']: tag['count'] async for tag in db['tags'].find({})})
+
+
+tag_indexes = DatabaseIndexes(build_tag_index, ttl=lambda: settings.tag_index_ttl)
+
+
+async def get_tag_index(db: AsyncIOMotorDatabase) -> TagIndex:
+    """Returns the in-memory tag index of a database, building it from the tags collection when missing or stale"""
+    return await tag_indexes.get(db)
+
+
+def drop_tag_index(db: AsyncIOMotorDatabase) -> None:
+    """Drops the in-memory tag index, it is rebuilt on the next lookup"""
+    tag_indexes.drop(db)
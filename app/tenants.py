@@ -0,0 +1,117 @@
+import asyncio
+import re
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import Request
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from .config import build_collection, settings
+
+DEFAULT_TENANT = 'default'
+TENANT_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,47}$')
+
+
+class Tenant:
+    """A tenant's database and its cached collection handles"""
+
+    def __init__(self, name: str, client: AsyncIOMotorClient):
+        self.name = name
+        self.client = client
+        self.database = client[database_name(name)]
+        self.collections: Dict[Tuple[str, str], AsyncIOMotorCollection] = {}
+
+    def collection(self, name: str, operation: str) -> AsyncIOMotorCollection:
+        if (name, operation) not in self.collections:
+            self.collections[name, operation] = build_collection(self.database, name, operation)
+        return self.collections[name, operation]
+
+
+def database_name(tenant: str) -> str:
+    if tenant == DEFAULT_TENANT:
+        return settings.default_database
+    return f'{settings.tenant_database_prefix}{tenant}'
+
+
+def is_allowed(tenant: str) -> bool:
+    return tenant == DEFAULT_TENANT or (
+        TENANT_PATTERN.match(tenant) is not None and tenant in settings.tenants.split(',')
+    )
+
+
+class TenantRegistry:
+    """Creates and prepares every tenant once per client on first use"""
+
+    def __init__(self):
+        self.tenants: Dict[str, Tenant] = {}
+        # Tenants by the id of their database handle, which they keep alive
+        self.databases: Dict[int, Tenant] = {}
+        self.locks: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, client: AsyncIOMotorClient, name: str,
+                  prepare: Callable[[AsyncIOMotorDatabase], Awaitable[None]]) -> Tenant:
+        """Returns a tenant, prepare sets up the database of a tenant before its first request uses it"""
+        tenant = self.tenants.get(name)
+        if tenant is not None and tenant.client is client:
+            return tenant
+        async with self.locks.setdefault(name, asyncio.Lock()):
+            tenant = self.tenants.get(name)
+            if tenant is None or tenant.client is not client:
+                tenant = Tenant(name, client)
+                await prepare(tenant.database)
+                previous = self.tenants.pop(name, None)
+                if previous is not None:
+                    del self.databases[id(previous.database)]
+                self.tenants[name] = tenant
+                self.databases[id(tenant.database)] = tenant
+        return tenant
+
+    def find(self, db: AsyncIOMotorDatabase) -> Optional[Tenant]:
+        """Returns the tenant a database handle belongs to, if it was created by the registry"""
+        return self.databases.get(id(db))
+
+    def clear(self) -> None:
+        self.tenants.clear()
+        self.databases.clear()
+        self.locks.clear()
+
+
+tenant_registry = TenantRegistry()
+
+
+def get_collection(db: AsyncIOMotorDatabase, name: str, operation: str) -> AsyncIOMotorCollection:
+    """Returns a collection using the read preference or write concern configured for an operation type.
+
+    Handles of tenant databases are created once and cached.
+    """
+    tenant = tenant_registry.find(db)
+    if tenant is None:
+        return build_collection(db, name, operation)
+    return tenant.collection(name, operation)
+
+
+def tenant_name(request: Request) -> str:
+    """The tenant of a request, from its path prefix or header, requests without one use the default tenant"""
+    if 'tenant' in request.scope:
+        # An empty path prefix such as /tenants//v1 is an unknown tenant, not the default one
+        return request.scope['tenant']
+    return request.headers.get(settings.tenant_header) or DEFAULT_TENANT
+
+
+class TenantPathMiddleware:
+    """Routes /tenants/<tenant>/v1/... to /v1/... for that tenant, as an alternative to the tenant header"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self.prefix = settings.tenant_path_prefix.rstrip('/') + '/'
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http' and scope['path'].startswith(self.prefix):
+            tenant, _, path = scope['path'][len(self.prefix):].partition('/')
+            scope = {
+                **scope,
+                'tenant': tenant,
+                'path': f'/{path}',
+                'root_path': scope.get('root_path', '') + self.prefix + tenant,
+            }
+        await self.app(scope, receive, send)
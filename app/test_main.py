@@ -1,15 +1,42 @@
+import asyncio
+import gzip
 import json
+from collections import Counter
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 
+import brotli
+import zstandard
+from bson import ObjectId
 from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
 from pymongo import MongoClient
-from pytest import fixture
-
-from .database import get_mongo_uri, get_database, db
+from pymongo.errors import BulkWriteError, WriteConcernError, WriteError
+from pymongo.read_preferences import ReadPreference
+from pymongo.write_concern import WriteConcern
+from pytest import approx, fixture
+
+from . import coalescing
+from .admission import AdmissionLimiter, Overloaded, limiters, tenant_limiters
+from .cache import ArticleCache, CacheInvalidator, DatabaseIndexes, TTLCache, article_cache
+from .coalescing import InsertBatcher, insert_batcher
+from .compression import negotiate
+from .config import Settings, settings
+from .database import AsyncIOMotorClient, get_mongo_uri, get_database, db
+from .health import Readiness, readiness
+from .indexes import HOT_QUERIES, index_models, plan_stages
+from .jobs import JobRunner, job_runner
+from .manage import run
+from .metrics import CommandMetrics
+from .models import Job
+from .search import search_indexes
+from .tags import TagIndex, tag_indexes
+from .tenants import get_collection, tenant_registry
 from .main import app
 
 
 async def override_get_database():
-    yield await get_database('test_articles')
+    yield db.client['test_articles']
 
 
 @fixture(scope='session')
@@ -25,13 +52,19 @@ def articles_db():
     """Create a synchronous DB connection for tests"""
     db_client = MongoClient(get_mongo_uri())
     articles_db = db_client['test_articles'].articles
+    tags_db = db_client['test_articles'].tags
 
-    # Clear DB before every test
+    # Clear DB and cache before every test
     articles_db.delete_many({})
+    tags_db.delete_many({})
+    article_cache.clear()
+    search_indexes.clear()
+    tag_indexes.clear()
     yield articles_db
 
     # Clear DB after all tests finish
     articles_db.delete_many({})
+    tags_db.delete_many({})
     return
 
 
@@ -180,6 +213,51 @@ class TestArticleViews:
         assert articles_db.count_documents({}) == 0
         assert len(articles_db.distinct('tags', {})) == 0
 
+    def test_view_creates_articles_in_bulk_from_a_json_array(self, test_client, articles_db):
+        payload = [
+            {'content': 'Buy owl treats', 'tags': ['Hogwarts', 'shopping']},
+            {'content': 'Invalid tag', 'tags': ['hog/warts']},
+            {'content': 'No tags at all'},
+            {'amazing-content': 'Not an article'},
+        ]
+
+        response = test_client.post(url='/v1/article/bulk?chunk_size=2', data=json.dumps(payload))
+
+        assert response.status_code == 200
+        assert response.json()['inserted'] == 2
+        assert response.json()['failed'] == 2
+        results = response.json()['results']
+        assert [result['index'] for result in results] == [0, 1, 2, 3]
+        assert 'id' in results[0] and 'id' in results[2]
+        assert 'error' in results[1] and 'error' in results[3]
+        assert articles_db.count_documents({}) == 2
+        assert set(articles_db.distinct('tags', {})) == {'hogwarts', 'shopping'}
+
+    def test_view_creates_articles_in_bulk_from_an_ndjson_stream(self, test_client, articles_db):
+        payload = '\n'.join([
+            json.dumps({'content': 'First', 'tags': ['one']}),
+            'this line is not JSON',
+            '',
+            json.dumps({'content': 'Second', 'tags': ['two']}),
+        ])
+
+        response = test_client.post(
+            url='/v1/article/bulk',
+            data=payload,
+            headers={'Content-Type': 'application/x-ndjson'},
+        )
+
+        assert response.status_code == 200
+        assert response.json()['inserted'] == 2
+        assert response.json()['results'][1] == {'index': 1, 'error': 'Invalid JSON'}
+        assert {article['content'] for article in articles_db.find({})} == {'First', 'Second'}
+
+    def test_view_does_not_create_articles_in_bulk_without_a_list(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article/bulk', data=json.dumps({'content': 'Just one'}))
+
+        assert response.status_code == 422
+        assert articles_db.count_documents({}) == 0
+
     def test_view_shows_all_articles_correctly(self, test_client, articles_db):
         # Create 3 tags and 2 articles
         articles_db.insert_many([
@@ -198,6 +276,54 @@ class TestArticleViews:
         assert response.status_code == 200
         assert len(response.json()) == 0
 
+    def test_view_paginates_articles_with_a_cursor(self, test_client, articles_db):
+        # Create 5 articles
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': []} for i in range(1, 6)])
+
+        # First page
+        response = test_client.get('/v1/article?limit=2')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['article1', 'article2']
+        next_cursor = response.headers['X-Next-Cursor']
+
+        # Second page
+        response = test_client.get(f'/v1/article?limit=2&after={next_cursor}')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['article3', 'article4']
+        next_cursor = response.headers['X-Next-Cursor']
+
+        # Last page has no next cursor
+        response = test_client.get(f'/v1/article?limit=2&after={next_cursor}')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['article5']
+        assert 'X-Next-Cursor' not in response.headers
+
+    def test_view_displays_correct_error_when_cursor_is_invalid(self, test_client, articles_db):
+        response = test_client.get('/v1/article?after=not-a-cursor')
+
+        assert response.status_code == 400
+        assert response.json()['cursor'] == 'not-a-cursor'
+
+    def test_view_streams_all_articles_as_ndjson(self, test_client, articles_db):
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': ['Tag']} for i in range(1, 4)])
+
+        response = test_client.get('/v1/article?stream=ndjson')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        lines = response.text.splitlines()
+        assert [json.loads(line)['content'] for line in lines] == ['article1', 'article2', 'article3']
+
+    def test_view_streams_all_articles_as_a_json_array(self, test_client, articles_db):
+        response = test_client.get('/v1/article?stream=json')
+        assert response.status_code == 200
+        assert response.json() == []
+
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': ['Tag']} for i in range(1, 4)])
+
+        response = test_client.get('/v1/article?stream=json')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['article1', 'article2', 'article3']
+
     def test_view_deletes_all_articles_and_tags_correctly(self, test_client, articles_db):
         # Create 3 tags and 2 articles
         articles_db.insert_many([
@@ -339,20 +465,162 @@ class TestSingleArticleViews:
         assert set(articles_db.distinct('tags', {})) == {'Tag1', 'Tag2', 'Tag3'}
 
 
+    def test_view_returns_not_modified_when_etag_matches(self, test_client, articles_db):
+        new_article_ids = self.create_n_articles_and_tags(n=1, articles_db=articles_db)
+
+        response = test_client.get(f'v1/article/{new_article_ids[0]}')
+        assert response.status_code == 200
+        etag = response.headers['ETag']
+
+        response = test_client.get(f'v1/article/{new_article_ids[0]}', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert not response.content
+        assert response.headers['ETag'] == etag
+
+    def test_view_updates_article_only_if_etag_matches(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Version 1', 'tags': ['old']}))
+        article_id = response.json()['id']
+        first_etag = response.headers['ETag']
+
+        # Update with the current ETag
+        response = test_client.put(
+            url=f'v1/article/{article_id}',
+            data=json.dumps({'content': 'Version 2', 'tags': ['new']}),
+            headers={'If-Match': first_etag},
+        )
+        assert response.status_code == 200
+        assert response.headers['ETag'] != first_etag
+        assert test_client.get(f'v1/article/{article_id}').headers['ETag'] == response.headers['ETag']
+
+        # A second update with the stale ETag conflicts
+        response = test_client.put(
+            url=f'v1/article/{article_id}',
+            data=json.dumps({'content': 'Version 3', 'tags': []}),
+            headers={'If-Match': first_etag},
+        )
+        assert response.status_code == 412
+        assert articles_db.find_one({})['content'] == 'Version 2'
+        assert test_client.get('v1/tags').json() == ['new']
+
+    def test_view_updates_articles_saved_without_a_version(self, test_client, articles_db):
+        new_article_ids = self.create_n_articles_and_tags(n=1, articles_db=articles_db)
+
+        response = test_client.put(
+            url=f'v1/article/{new_article_ids[0]}',
+            data=json.dumps({'content': 'Versioned', 'tags': []}),
+            headers={'If-Match': '"0"'},
+        )
+        assert response.status_code == 200
+        assert response.headers['ETag'] == '"1"'
+
+        # Updating an unknown article with an ETag is still a 404
+        response = test_client.put(
+            url='v1/article/999999999999999999999999',
+            data=json.dumps({'content': 'New Stuff', 'tags': []}),
+            headers={'If-Match': '"1"'},
+        )
+        assert response.status_code == 404
+
+
 class TestTagsView:
+    def create_articles_with_tags(self, test_client):
+        # Create 4 tags, 'wizard' is used twice and 'muggle' three times
+        payload = [
+            {'content': 'article1', 'tags': ['wizard', 'muggle']},
+            {'content': 'article2', 'tags': ['muggle']},
+            {'content': 'article3', 'tags': ['dementor', 'muggle', 'wizard']},
+            {'content': 'article4', 'tags': ['zombie']},
+        ]
+        test_client.post(url='/v1/article/bulk', data=json.dumps(payload))
+
     def test_view_shows_all_tags(self, test_client, articles_db):
-        # Create 4 tags
+        self.create_articles_with_tags(test_client)
+
+        response = test_client.get('v1/tags')
+
+        assert response.status_code == 200
+        assert response.json() == ['dementor', 'muggle', 'wizard', 'zombie']
+
+    def test_view_shows_tags_by_popularity_with_counts(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+
+        response = test_client.get('v1/tags?sort=popularity&counts=true')
+
+        assert response.status_code == 200
+        assert response.json() == [
+            {'tag': 'muggle', 'count': 3},
+            {'tag': 'wizard', 'count': 2},
+            {'tag': 'dementor', 'count': 1},
+            {'tag': 'zombie', 'count': 1},
+        ]
+
+    def test_view_keeps_tag_counts_up_to_date_on_writes(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'a', 'tags': ['wizard', 'muggle']}))
+        article_id = response.json()['id']
+        test_client.post(url='/v1/article', data=json.dumps({'content': 'b', 'tags': ['wizard']}))
+
+        # Replace 'muggle' with 'zombie'
+        test_client.put(url=f'/v1/article/{article_id}', data=json.dumps({'content': 'a', 'tags': ['wizard', 'zombie']}))
+        response = test_client.get('v1/tags?counts=true')
+        assert response.json() == [{'tag': 'wizard', 'count': 2}, {'tag': 'zombie', 'count': 1}]
+
+        # Deleting the article drops 'zombie' whose count reaches zero
+        test_client.delete(f'/v1/article/{article_id}')
+        response = test_client.get('v1/tags?counts=true')
+        assert response.json() == [{'tag': 'wizard', 'count': 1}]
+
+        # Deleting all articles drops all tags
+        test_client.delete('/v1/article')
+        assert test_client.get('v1/tags').json() == []
+
+    def test_rebuild_recomputes_tag_counts_from_articles(self, test_client, articles_db):
         articles_db.insert_many([
             {'id_int': 1, 'content': 'article1', 'tags': ['wizard']},
-            {'id_int': 2, 'content': 'article2', 'tags': ['muggle']},
-            {'id_int': 2, 'content': 'article2', 'tags': ['dementor']},
-            {'id_int': 2, 'content': 'article2', 'tags': ['zombie']},
+            {'id_int': 2, 'content': 'article2', 'tags': ['wizard', 'muggle']},
         ])
 
-        response = test_client.get('v1/tags')
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(run('rebuild-tags', 'test_articles')) == 0
+        loop.close()
+
+        response = test_client.get('v1/tags?sort=popularity&counts=true')
+        assert response.json() == [{'tag': 'wizard', 'count': 2}, {'tag': 'muggle', 'count': 1}]
 
+    def test_view_suggests_tags_by_prefix(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+        test_client.post(url='/v1/article', data=json.dumps({'content': 'article5', 'tags': ['mudblood']}))
+
+        response = test_client.get('v1/tags/suggest?prefix=mu')
         assert response.status_code == 200
-        assert set(response.json()) == {'wizard', 'muggle', 'dementor', 'zombie'}
+        assert response.json() == [{'tag': 'mudblood', 'count': 1}, {'tag': 'muggle', 'count': 3}]
+
+        assert test_client.get('v1/tags/suggest?prefix=mu&limit=1').json() == [{'tag': 'mudblood', 'count': 1}]
+        assert test_client.get('v1/tags/suggest?prefix=x').json() == []
+        assert [tag['tag'] for tag in test_client.get('v1/tags/suggest').json()] == [
+            'dementor', 'mudblood', 'muggle', 'wizard', 'zombie',
+        ]
+
+    def test_view_suggestions_follow_writes(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+        assert test_client.get('v1/tags/suggest?prefix=z').json() == [{'tag': 'zombie', 'count': 1}]
+
+        # Replace the only 'zombie' tag, the index built by the first lookup is updated in place
+        article_id = articles_db.find_one({'content': 'article4'})['_id']
+        test_client.put(url=f'/v1/article/{article_id}', data=json.dumps({'content': 'article4', 'tags': ['zealot']}))
+        assert test_client.get('v1/tags/suggest?prefix=z').json() == [{'tag': 'zealot', 'count': 1}]
+
+        test_client.delete(f'/v1/article/{article_id}')
+        assert test_client.get('v1/tags/suggest?prefix=z').json() == []
+
+        test_client.delete('/v1/article')
+        assert test_client.get('v1/tags/suggest').json() == []
+
+    def test_tag_index_keeps_names_sorted(self):
+        index = TagIndex({'b': 1, 'd': 2, 'unused': 0})
+        index.apply(Counter({'c': 1, 'a': 1, 'd': -2, 'b': 1}))
+
+        assert index.names == ['a', 'b', 'c']
+        assert index.suggest('', 10) == [('a', 1), ('b', 2), ('c', 1)]
 
 
 class TestSingleTagView:
@@ -389,6 +657,19 @@ class TestSingleTagView:
         assert response.json()[1]['content'] == 'Master of Puppets'
         assert response.json()[1]['tags'] == ['song', 'metallica']
 
+    def test_view_paginates_articles_with_tag(self, test_client, articles_db):
+        # Create 3 tags and 3 articles
+        self.create_song_name_articles_with_tags(articles_db)
+
+        response = test_client.get('/v1/article/tag/song?limit=2')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['Battery', 'Inner Universe']
+
+        response = test_client.get(f"/v1/article/tag/song?limit=2&after={response.headers['X-Next-Cursor']}")
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['Master of Puppets']
+        assert 'X-Next-Cursor' not in response.headers
+
     def test_view_displays_correct_error_when_tag_not_found(self, test_client, articles_db):
         # Create 3 tags and 3 articles
         self.create_song_name_articles_with_tags(articles_db)
@@ -398,3 +679,900 @@ class TestSingleTagView:
 
         assert response.status_code == 200
         assert len(response.json()) == 0
+
+
+class TestIndexes:
+    def test_plan_stages_finds_nested_stages(self):
+        plan = {
+            'stage': 'FETCH',
+            'inputStage': {'stage': 'OR', 'inputStages': [{'stage': 'IXSCAN'}, {'stage': 'COLLSCAN'}]},
+        }
+
+        assert plan_stages(plan) == {'FETCH', 'OR', 'IXSCAN', 'COLLSCAN'}
+
+    def test_hot_queries_do_not_scan_the_whole_collection(self, articles_db):
+        articles_db.create_indexes(index_models('articles'))
+        articles_db.database.tags.create_indexes(index_models('tags'))
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': [f'Tag{i}']} for i in range(10)])
+
+        for name, command in HOT_QUERIES.items():
+            explain = articles_db.database.command({'explain': command, 'verbosity': 'queryPlanner'})
+            assert 'COLLSCAN' not in plan_stages(explain['queryPlanner']['winningPlan']), name
+
+
+class TestArticleCache:
+    def test_cache_evicts_least_recently_used_entries(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+
+        # 'b' is the least recently used entry
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('c') == 3
+        assert cache.stats()['hits'] == 2
+        assert cache.stats()['misses'] == 1
+        assert cache.stats()['evictions'] == 1
+
+    def test_cache_expires_entries_after_ttl(self):
+        now = [0]
+        cache = TTLCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set('a', 1)
+        assert cache.get('a') == 1
+
+        now[0] = 10
+        assert cache.get('a') is None
+        assert cache.stats()['expirations'] == 1
+
+    def test_view_serves_cached_article_until_it_is_updated(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Original', 'tags': []}))
+        article_id = response.json()['id']
+        assert test_client.get(f'/v1/article/{article_id}').json()['content'] == 'Original'
+
+        # Writes made behind the app's back are not seen until the entry is invalidated
+        articles_db.update_one({}, {'$set': {'content': 'Changed directly'}})
+        assert test_client.get(f'/v1/article/{article_id}').json()['content'] == 'Original'
+
+        test_client.put(url=f'/v1/article/{article_id}', data=json.dumps({'content': 'Updated', 'tags': []}))
+        assert test_client.get(f'/v1/article/{article_id}').json()['content'] == 'Updated'
+
+    def test_view_invalidates_cached_article_requested_with_uppercase_id(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Original', 'tags': []}))
+        article_id = response.json()['id']
+        assert test_client.get(f'/v1/article/{article_id.upper()}').json()['content'] == 'Original'
+
+        test_client.put(url=f'/v1/article/{article_id}', data=json.dumps({'content': 'Updated', 'tags': []}))
+        assert test_client.get(f'/v1/article/{article_id.upper()}').json()['content'] == 'Updated'
+
+        test_client.delete(f'/v1/article/{article_id}')
+        assert test_client.get(f'/v1/article/{article_id.upper()}').status_code == 404
+
+    def test_view_invalidates_cached_tag_pages_on_writes(self, test_client, articles_db):
+        assert test_client.get('/v1/article/tag/song').json() == []
+
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Battery', 'tags': ['song']}))
+        assert [article['content'] for article in test_client.get('/v1/article/tag/song').json()] == ['Battery']
+
+        test_client.delete(f"/v1/article/{response.json()['id']}")
+        assert test_client.get('/v1/article/tag/song').json() == []
+
+    def test_cache_skips_values_read_before_an_invalidation(self):
+        cache = ArticleCache(maxsize=10, ttl=60)
+        generation = cache.generation('articles')
+
+        # A write invalidates the tag page while its read is in flight
+        cache.invalidate_tags('articles', ['owl'])
+        cache.set_unless_invalidated(('tag', 'articles', 'owl'), 'stale page', generation)
+        assert cache.get(('tag', 'articles', 'owl')) is None
+
+        # Other databases are not affected
+        cache.set_unless_invalidated(('tag', 'articles_acme', 'owl'), 'page', cache.generation('articles_acme'))
+        assert cache.get(('tag', 'articles_acme', 'owl')) == 'page'
+
+    def test_database_indexes_are_built_once_and_rebuilt_after_their_ttl(self):
+        builds = []
+
+        async def build(database):
+            builds.append(database.name)
+            await asyncio.sleep(0)
+            return len(builds)
+
+        ttl = [60]
+        indexes = DatabaseIndexes(build, ttl=lambda: ttl[0])
+        database = SimpleNamespace(name='articles')
+
+        async def scenario():
+            assert await asyncio.gather(indexes.get(database), indexes.get(database)) == [1, 1]
+            ttl[0] = 0
+            return await indexes.get(database)
+
+        loop = asyncio.new_event_loop()
+        assert loop.run_until_complete(scenario()) == 2
+        loop.close()
+        assert builds == ['articles', 'articles']
+
+    def test_invalidator_routes_change_events_to_their_database(self):
+        cache = ArticleCache(maxsize=10, ttl=60)
+        invalidator = CacheInvalidator(cache, poll_interval=1)
+        invalidator.databases = {'articles': None, 'articles_acme': None}
+        for db_name in ('articles', 'articles_acme'):
+            cache.set(('article', db_name, 'a1'), 1)
+            cache.set(('tag', db_name, 'owl'), 2)
+
+        invalidator.apply({
+            'operationType': 'update', 'ns': {'db': 'articles_acme', 'coll': 'articles'}, 'documentKey': {'_id': 'a1'},
+        })
+        assert cache.get(('article', 'articles_acme', 'a1')) is None
+        assert cache.get(('tag', 'articles_acme', 'owl')) is None
+        assert cache.get(('article', 'articles', 'a1')) == 1
+        assert cache.get(('tag', 'articles', 'owl')) == 2
+
+        # Databases this worker doesn't serve are ignored
+        invalidator.apply({'operationType': 'drop', 'ns': {'db': 'articles_globex', 'coll': 'articles'}})
+        assert cache.stats()['size'] == 2
+        invalidator.apply({'operationType': 'drop', 'ns': {'db': 'articles', 'coll': 'articles'}})
+        assert cache.stats()['size'] == 0
+
+    def test_invalidator_follows_every_database_with_one_task(self, test_client):
+        invalidator = CacheInvalidator(ArticleCache(maxsize=10, ttl=60), poll_interval=1)
+
+        async def scenario():
+            invalidator.start(db.client['articles'])
+            task = invalidator.task
+            invalidator.start(db.client['articles_acme'])
+            assert invalidator.task is task
+            assert set(invalidator.databases) == {'articles', 'articles_acme'}
+            await invalidator.stop()
+            assert invalidator.task is None and task.cancelled()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(scenario())
+        loop.close()
+
+
+class TestTagQueryView:
+    def create_articles_with_tags(self, articles_db):
+        articles_db.insert_many([
+            {'id_int': 1, 'content': 'Battery', 'tags': ['song', 'metallica', 'thrash']},
+            {'id_int': 2, 'content': 'Inner Universe', 'tags': ['song', 'yoko kanno']},
+            {'id_int': 3, 'content': 'Master of Puppets', 'tags': ['song', 'metallica']},
+            {'id_int': 4, 'content': 'Ride the Lightning', 'tags': ['album', 'metallica']},
+        ])
+
+    def test_view_combines_all_any_and_none_tags(self, test_client, articles_db):
+        self.create_articles_with_tags(articles_db)
+
+        response = test_client.get('/v1/article/query?all=song&all=metallica')
+        assert [article['content'] for article in response.json()] == ['Battery', 'Master of Puppets']
+
+        response = test_client.get('/v1/article/query?any=yoko kanno&any=album')
+        assert [article['content'] for article in response.json()] == ['Inner Universe', 'Ride the Lightning']
+
+        response = test_client.get('/v1/article/query?all=metallica&none=thrash')
+        assert [article['content'] for article in response.json()] == ['Master of Puppets', 'Ride the Lightning']
+
+    def test_view_returns_facet_counts_of_co_occurring_tags(self, test_client, articles_db):
+        self.create_articles_with_tags(articles_db)
+
+        response = test_client.get('/v1/article/query?all=metallica&facets=true&limit=2')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()['articles']] == ['Battery', 'Master of Puppets']
+        assert response.json()['facets'] == [
+            {'tag': 'song', 'count': 2},
+            {'tag': 'album', 'count': 1},
+            {'tag': 'thrash', 'count': 1},
+        ]
+
+        # Facets count every match, not only the current page
+        response = test_client.get(f"/v1/article/query?all=metallica&facets=true&after={response.headers['X-Next-Cursor']}")
+        assert [article['content'] for article in response.json()['articles']] == ['Ride the Lightning']
+        assert len(response.json()['facets']) == 3
+
+    def test_view_requires_at_least_one_tag(self, test_client, articles_db):
+        response = test_client.get('/v1/article/query')
+        assert response.status_code == 422
+
+
+class TestSearchView:
+    def create_potion_articles(self, articles_db):
+        articles_db.insert_many([
+            {'id_int': 1, 'content': 'Brew a potion, then another potion', 'tags': ['potions']},
+            {'id_int': 2, 'content': 'Feed the owl', 'tags': ['chores']},
+            {'id_int': 3, 'content': 'Buy potion ingredients and feed the owl', 'tags': ['chores', 'shopping']},
+        ])
+
+    def test_view_ranks_matching_articles_by_relevance(self, test_client, articles_db):
+        self.create_potion_articles(articles_db)
+
+        response = test_client.get('/v1/article/search?q=potion')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == [
+            'Brew a potion, then another potion',
+            'Buy potion ingredients and feed the owl',
+        ]
+        assert response.json()[0]['score'] > response.json()[1]['score']
+
+        response = test_client.get('/v1/article/search?q=potion&limit=1&offset=1')
+        assert [article['content'] for article in response.json()] == ['Buy potion ingredients and feed the owl']
+
+    def test_view_filters_search_results_by_tags(self, test_client, articles_db):
+        self.create_potion_articles(articles_db)
+
+        response = test_client.get('/v1/article/search?q=owl&tags=shopping')
+        assert response.status_code == 200
+        assert [article['content'] for article in response.json()] == ['Buy potion ingredients and feed the owl']
+
+    def test_view_keeps_search_results_up_to_date_on_writes(self, test_client, articles_db):
+        self.create_potion_articles(articles_db)
+        assert len(test_client.get('/v1/article/search?q=broomstick').json()) == 0
+
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Polish the broomstick'}))
+        assert [article['content'] for article in test_client.get('/v1/article/search?q=broomstick').json()] == [
+            'Polish the broomstick'
+        ]
+
+        test_client.delete(f"/v1/article/{response.json()['id']}")
+        assert len(test_client.get('/v1/article/search?q=broomstick').json()) == 0
+
+
+class TestMetricsView:
+    def test_view_exposes_route_latencies_and_cache_counters(self, test_client, articles_db):
+        new_article = articles_db.insert_one({'id_int': 1, 'content': 'article1', 'tags': ['Tag1']})
+        test_client.get(f'/v1/article/{new_article.inserted_id}')
+        test_client.get(f'/v1/article/{new_article.inserted_id}')
+
+        response = test_client.get('/metrics')
+        assert response.status_code == 200
+        assert 'http_request_duration_seconds_count{method="GET",route="/v1/article/{id}",status="200"}' in response.text
+        assert 'http_requests_in_flight' in response.text
+        assert 'article_cache_events_total{event="hits"}' in response.text
+
+    def test_command_listener_records_command_durations(self):
+        class Event:
+            command_name = 'find'
+            duration_micros = 1500
+
+        labels = {'command': 'find', 'status': 'succeeded'}
+        before = REGISTRY.get_sample_value('mongo_command_duration_seconds_sum', labels) or 0
+        CommandMetrics().succeeded(Event())
+        assert REGISTRY.get_sample_value('mongo_command_duration_seconds_sum', labels) == approx(before + 0.0015)
+
+
+class TestWriteCoalescing:
+    def test_batcher_resolves_each_insert_with_its_own_id_or_error(self, articles_db):
+        duplicate_id = ObjectId()
+        documents = [
+            {'_id': duplicate_id, 'content': 'first', 'tags': ['owl'], 'version': 1},
+            {'_id': duplicate_id, 'content': 'duplicate', 'tags': ['owl'], 'version': 1},
+            {'content': 'third', 'tags': ['owl'], 'version': 1},
+        ]
+
+        async def insert_concurrently():
+            client = AsyncIOMotorClient(get_mongo_uri())
+            batcher = InsertBatcher(enabled=True, max_batch_size=10, max_delay=0.01)
+            results = await asyncio.gather(
+                *(batcher.insert(client['test_articles'], document) for document in documents),
+                return_exceptions=True,
+            )
+            await batcher.close()
+            client.close()
+            return results
+
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(insert_concurrently())
+        loop.close()
+
+        assert results[0] == duplicate_id
+        assert isinstance(results[1], WriteError)
+        assert isinstance(results[2], ObjectId)
+        assert {article['content'] for article in articles_db.find({})} == {'first', 'third'}
+        assert articles_db.database.tags.find_one({'_id': 'owl'})['count'] == 2
+
+    class FakeDatabase:
+        """A database whose insert_many raises a prepared error"""
+
+        def __init__(self, name, error=None):
+            self.name = name
+            self.error = error
+
+        def get_collection(self, name, **options):
+            return self
+
+        async def insert_many(self, documents, ordered):
+            if self.error is not None:
+                raise self.error
+
+    def write_batch(self, databases, monkeypatch, bookkeeping):
+        monkeypatch.setattr(coalescing, 'articles_inserted', bookkeeping)
+        batcher = InsertBatcher(enabled=True, max_batch_size=10, max_delay=0.01)
+
+        async def scenario():
+            futures = [asyncio.get_event_loop().create_future() for _ in databases]
+            batch = [(db, {'_id': ObjectId(), 'tags': []}, future) for db, future in zip(databases, futures)]
+            await batcher.write(batch)
+            return [future.exception() or future.result() for future in futures]
+
+        loop = asyncio.new_event_loop()
+        results = loop.run_until_complete(scenario())
+        loop.close()
+        return results
+
+    def test_batcher_answers_every_database_when_one_fails(self, monkeypatch):
+        written = []
+
+        async def bookkeeping(db, documents, operation):
+            written.append(db.name)
+            if db.name == 'broken':
+                raise RuntimeError('tag counts failed')
+
+        results = self.write_batch([self.FakeDatabase('broken'), self.FakeDatabase('healthy')], monkeypatch, bookkeeping)
+
+        assert written == ['broken', 'healthy']
+        assert isinstance(results[0], RuntimeError)
+        assert isinstance(results[1], ObjectId)
+
+    def test_batcher_fails_inserts_which_missed_the_write_concern(self, monkeypatch):
+        error = BulkWriteError({
+            'writeErrors': [], 'writeConcernErrors': [{'errmsg': 'waiting for replication timed out', 'code': 64}],
+        })
+        inserted = []
+
+        async def bookkeeping(db, documents, operation):
+            inserted.extend(documents)
+
+        results = self.write_batch([self.FakeDatabase('articles', error)], monkeypatch, bookkeeping)
+
+        assert isinstance(results[0], WriteConcernError)
+        # The article was written, so it is still counted
+        assert len(inserted) == 1
+
+    def test_view_creates_articles_through_the_batcher(self, test_client, articles_db, monkeypatch):
+        monkeypatch.setattr(insert_batcher, 'enabled', True)
+
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'Batched', 'tags': ['Owl']}))
+
+        assert response.status_code == 200
+        assert articles_db.find_one({'_id': ObjectId(response.json()['id'])})['content'] == 'Batched'
+        assert test_client.get('v1/tags').json() == ['owl']
+
+
+class TestExportImportViews:
+    def test_view_exports_all_articles_as_ndjson(self, test_client, articles_db):
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': [f'Tag{i}']} for i in range(1, 4)])
+
+        response = test_client.get('/v1/article/export')
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line['content'] for line in lines] == ['article1', 'article2', 'article3']
+
+        # Resume after the first article
+        response = test_client.get(f"/v1/article/export?after={lines[0]['id']}")
+        assert [json.loads(line)['content'] for line in response.text.splitlines()] == ['article2', 'article3']
+
+    def test_view_exports_gzip_compressed_ndjson(self, test_client, articles_db):
+        articles_db.insert_many([{'id_int': i, 'content': f'article{i}', 'tags': []} for i in range(1, 4)])
+
+        response = test_client.get('/v1/article/export?compression=gzip')
+        assert response.status_code == 200
+        assert response.headers['content-type'] == 'application/gzip'
+        lines = gzip.decompress(response.content).decode().splitlines()
+        assert [json.loads(line)['content'] for line in lines] == ['article1', 'article2', 'article3']
+
+    def test_view_imports_an_export_and_skips_existing_articles(self, test_client, articles_db):
+        test_client.post(url='/v1/article/bulk', data=json.dumps([
+            {'content': 'article1', 'tags': ['owl']},
+            {'content': 'article2', 'tags': ['owl', 'wand']},
+        ]))
+        export = test_client.get('/v1/article/export?compression=gzip').content
+        test_client.delete('/v1/article')
+
+        # Import everything
+        response = test_client.post(url='/v1/article/import', data=export, headers={'Content-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.json()['inserted'] == 2
+        assert response.json()['checkpoint'] == str(articles_db.find_one({'content': 'article2'})['_id'])
+        assert test_client.get('v1/tags?counts=true').json() == [{'tag': 'owl', 'count': 2}, {'tag': 'wand', 'count': 1}]
+
+        # Re-running an interrupted import only skips the articles which already exist
+        response = test_client.post(url='/v1/article/import', data=gzip.decompress(export))
+        assert response.json()['inserted'] == 0
+        assert response.json()['skipped'] == 2
+        assert articles_db.count_documents({}) == 2
+
+    def test_view_reports_invalid_lines_during_import(self, test_client, articles_db):
+        payload = '\n'.join([
+            json.dumps({'id': str(ObjectId()), 'content': 'valid', 'tags': []}),
+            json.dumps({'id': 'not-an-id', 'content': 'invalid id'}),
+            json.dumps({'content': 'invalid tag', 'tags': ['hog/warts']}),
+        ])
+
+        response = test_client.post(url='/v1/article/import', data=payload)
+        assert response.json()['inserted'] == 1
+        assert response.json()['failed'] == 2
+        assert [error['index'] for error in response.json()['errors']] == [1, 2]
+
+
+class TestAdmissionControl:
+    def test_limiter_rejects_when_the_queue_is_full(self):
+        limiter = AdmissionLimiter('test', concurrency=1, queue_size=1, timeout=1)
+
+        async def scenario():
+            await limiter.acquire()
+            waiting = asyncio.ensure_future(limiter.acquire())
+            await asyncio.sleep(0)
+            assert limiter.waiting == 1
+            try:
+                await limiter.acquire()
+            except Overloaded as error:
+                assert error.reason == 'queue_full'
+            else:
+                raise AssertionError('expected the request to be shed')
+            # The queued request gets the slot once it is released
+            limiter.release()
+            await waiting
+            limiter.release()
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(scenario())
+        loop.close()
+
+    def test_limiter_rejects_after_the_deadline(self):
+        limiter = AdmissionLimiter('test', concurrency=1, queue_size=1, timeout=0.01)
+
+        async def scenario():
+            await limiter.acquire()
+            try:
+                await limiter.acquire()
+            except Overloaded as error:
+                assert error.reason == 'deadline'
+            else:
+                raise AssertionError('expected the request to be shed')
+            assert limiter.waiting == 0
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(scenario())
+        loop.close()
+
+    def test_view_answers_503_with_retry_after_when_overloaded(self, test_client, articles_db):
+        admin = limiters['admin']
+        # No slots and no queue, every admin request is shed while reads keep working
+        limiters['admin'] = AdmissionLimiter('admin', concurrency=1, queue_size=0, timeout=3)
+        limiters['admin'].semaphore = asyncio.Semaphore(0)
+        try:
+            response = test_client.delete('/v1/article')
+            assert response.status_code == 503
+            assert response.headers['retry-after'] == '3'
+            assert test_client.get('/v1/article').status_code == 200
+        finally:
+            limiters['admin'] = admin
+
+    def test_view_releases_slots_after_each_request(self, test_client, articles_db):
+        for _ in range(3):
+            test_client.post(url='/v1/article', data=json.dumps({'content': 'article', 'tags': []}))
+        assert limiters['writes'].waiting == 0
+        assert not limiters['writes'].semaphore.locked()
+        assert limiters['writes'].semaphore._value == limiters['writes'].concurrency
+
+
+class TestSettings:
+    def test_settings_are_read_from_the_environment(self, monkeypatch):
+        monkeypatch.setenv('MONGO_HOST', 'mongo.example')
+        monkeypatch.setenv('MONGO_MAX_POOL_SIZE', '20')
+        monkeypatch.setenv('MONGO_COMPRESSORS', 'zstd,zlib')
+        monkeypatch.setenv('READ_PREFERENCE_LIST', 'secondaryPreferred')
+        monkeypatch.setenv('WRITE_CONCERN_BULK_W', 'majority')
+        monkeypatch.setenv('WRITE_COALESCING_J', 'true')
+
+        settings = Settings()
+
+        assert '@mongo.example:' in settings.mongo_uri
+        assert settings.client_options()['maxPoolSize'] == 20
+        assert settings.client_options()['compressors'] == 'zstd,zlib'
+        assert 'socketTimeoutMS' not in settings.client_options()
+        assert settings.read_preference('list') == ReadPreference.SECONDARY_PREFERRED
+        assert settings.read_preference('single') == ReadPreference.PRIMARY
+        assert settings.write_concern('bulk') == WriteConcern(w='majority')
+        assert settings.write_concern('coalesced') == WriteConcern(w=1, j=True)
+        assert settings.write_concern('writes') == WriteConcern()
+
+    def test_settings_reject_unknown_values(self, monkeypatch):
+        monkeypatch.setenv('MONGO_COMPRESSORS', 'zstd,lz4')
+        try:
+            Settings()
+        except ValueError as error:
+            assert 'lz4' in str(error)
+        else:
+            raise AssertionError('expected unknown compressors to be rejected')
+
+
+class TestHealthViews:
+    def test_view_reports_liveness(self, test_client):
+        response = test_client.get('/health/live')
+        assert response.status_code == 200
+        assert response.json() == {'status': 'alive'}
+
+    def test_view_reports_warm_up_stages_once_ready(self, test_client):
+        response = test_client.get('/health/ready')
+
+        assert response.status_code == 200
+        assert response.json()['ready'] is True
+        assert response.json()['import_to_ready_seconds'] > 0
+        assert {name: stage['status'] for name, stage in response.json()['stages'].items()} == {
+            'ping': 'ok', 'pool': 'ok', 'indexes': 'ok', 'caches': 'ok',
+        }
+        assert 'app_import_to_ready_seconds' in test_client.get('/metrics').text
+
+    def test_view_is_not_ready_while_stopping(self, test_client, monkeypatch):
+        monkeypatch.setattr(readiness, 'ready_after', None)
+
+        response = test_client.get('/health/ready')
+
+        assert response.status_code == 503
+        assert response.json()['ready'] is False
+
+    def test_failed_optional_stage_does_not_block_readiness(self):
+        async def fail():
+            raise RuntimeError('cold')
+
+        async def scenario():
+            state = Readiness()
+            await state.stage('caches', fail(), required=False)
+            assert not state.ready
+            state.mark_ready()
+            assert state.ready
+            assert state.stages['caches']['status'] == 'failed'
+
+            try:
+                await state.stage('ping', fail())
+            except RuntimeError:
+                pass
+            else:
+                raise AssertionError('expected a failed required stage to be raised')
+            assert not state.ready
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(scenario())
+        loop.close()
+
+
+class TestJobViews:
+    @fixture(autouse=True)
+    def fast_jobs(self, monkeypatch):
+        monkeypatch.setattr(job_runner, 'batch_size', 2)
+        monkeypatch.setattr(job_runner, 'batch_delay', 0)
+
+    def create_articles_with_tags(self, test_client):
+        test_client.post(url='/v1/article/bulk', data=json.dumps([
+            {'content': 'article1', 'tags': ['wizard', 'muggle']},
+            {'content': 'article2', 'tags': ['muggle']},
+            {'content': 'article3', 'tags': ['witch', 'wizard']},
+            {'content': 'article4', 'tags': ['wizard']},
+        ]))
+
+    def wait_for(self, test_client, response):
+        """Polls a submitted job, the test client only runs the event loop during requests"""
+        assert response.status_code == 202
+        for _ in range(100):
+            job = test_client.get(response.headers['location']).json()
+            if job['status'] not in ('queued', 'running'):
+                return job
+        raise AssertionError('job did not finish')
+
+    def test_view_renames_and_merges_a_tag(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+
+        job = {'type': 'rename_tag', 'source': 'wizard', 'target': 'Witch'}
+        response = test_client.post(url='/v1/jobs', data=json.dumps(job))
+        job = self.wait_for(test_client, response)
+
+        assert job['status'] == 'succeeded'
+        assert job['params'] == {'source': 'wizard', 'target': 'witch'}
+        assert (job['processed'], job['total']) == (3, 3)
+        assert sorted(article['tags'] for article in articles_db.find({}, sort=[('_id', 1)])) == sorted([
+            ['witch', 'muggle'], ['muggle'], ['witch'], ['witch'],
+        ])
+        assert test_client.get('v1/tags?counts=true').json() == [
+            {'tag': 'muggle', 'count': 2}, {'tag': 'witch', 'count': 3},
+        ]
+
+    def test_view_deletes_articles_matching_a_tag_query(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+
+        job = {'type': 'delete_articles', 'all': ['wizard'], 'none': ['witch']}
+        response = test_client.post(url='/v1/jobs', data=json.dumps(job))
+        job = self.wait_for(test_client, response)
+
+        assert job['status'] == 'succeeded'
+        assert [article['content'] for article in articles_db.find({})] == ['article2', 'article3']
+        assert test_client.get('v1/tags?counts=true').json() == [
+            {'tag': 'muggle', 'count': 1}, {'tag': 'witch', 'count': 1}, {'tag': 'wizard', 'count': 1},
+        ]
+
+    def test_delete_job_counts_only_what_it_deleted(self, test_client, articles_db, monkeypatch):
+        self.create_articles_with_tags(test_client)
+        batches = job_runner.batches
+
+        async def batches_with_concurrent_writes(db, job_id, query):
+            async for articles in batches(db, job_id, query):
+                # Written behind the app's back, so their tag counts are not changed
+                articles_db.update_one({'content': 'article4'}, {'$set': {'tags': ['owl']}})
+                articles_db.delete_one({'content': 'article3'})
+                yield articles
+
+        monkeypatch.setattr(job_runner, 'batches', batches_with_concurrent_writes)
+        job = {'type': 'delete_articles', 'all': ['wizard']}
+        job = self.wait_for(test_client, test_client.post(url='/v1/jobs', data=json.dumps(job)))
+
+        assert job['status'] == 'succeeded'
+        assert [article['content'] for article in articles_db.find({})] == ['article2', 'article4']
+        assert test_client.get('v1/tags?counts=true').json() == [
+            {'tag': 'muggle', 'count': 1}, {'tag': 'witch', 'count': 1}, {'tag': 'wizard', 'count': 2},
+        ]
+
+    def test_view_deletes_all_articles_in_the_background(self, test_client, articles_db):
+        self.create_articles_with_tags(test_client)
+
+        job = self.wait_for(test_client, test_client.delete('/v1/article?background=true'))
+
+        assert job['type'] == 'delete_all'
+        assert job['status'] == 'succeeded'
+        assert articles_db.count_documents({}) == 0
+        assert test_client.get('v1/tags').json() == []
+        assert job['id'] in [recent['id'] for recent in test_client.get('v1/jobs').json()]
+
+    def test_running_job_is_queued_again_on_shutdown(self, articles_db):
+        articles_db.insert_many([{'content': f'article{i}', 'tags': ['wizard']} for i in range(3)])
+
+        async def interrupt():
+            client = AsyncIOMotorClient(get_mongo_uri())
+            runner = JobRunner(batch_size=1, batch_delay=10, stale_after=300)
+            document = await runner.submit(client['test_articles'], Job(type='delete_articles', all=['wizard']))
+            while articles_db.count_documents({}) == 3:
+                await asyncio.sleep(0.01)
+            await runner.close()
+            client.close()
+            return document['_id']
+
+        loop = asyncio.new_event_loop()
+        job_id = loop.run_until_complete(interrupt())
+        loop.close()
+
+        assert articles_db.database.jobs.find_one({'_id': job_id})['status'] == 'queued'
+        assert articles_db.count_documents({}) == 2
+        articles_db.database.jobs.delete_one({'_id': job_id})
+
+    def test_view_rejects_invalid_jobs(self, test_client, articles_db):
+        for job in [{'type': 'rename_tag', 'source': 'wizard'}, {'type': 'delete_articles'}, {'type': 'compact'}]:
+            assert test_client.post(url='/v1/jobs', data=json.dumps(job)).status_code == 422
+        assert test_client.get(f'/v1/jobs/{ObjectId()}').status_code == 404
+
+
+class TestSparseFieldsAndCounts:
+    def create_articles(self, test_client):
+        test_client.post(url='/v1/article/bulk', data=json.dumps([
+            {'content': 'Hide my wand', 'tags': ['wizard']},
+            {'content': 'Feed the owl', 'tags': ['wizard', 'owl']},
+            {'content': 'Buy milk', 'tags': []},
+        ]))
+
+    def test_view_returns_only_the_selected_fields(self, test_client, articles_db):
+        self.create_articles(test_client)
+
+        response = test_client.get('/v1/article?fields=id,tags')
+        assert response.status_code == 200
+        assert [sorted(article) for article in response.json()] == [['id', 'tags']] * 3
+
+        assert [sorted(article) for article in test_client.get('/v1/article?fields=id').json()] == [['id']] * 3
+        assert test_client.get('/v1/article?fields=id,author').status_code == 422
+
+    def test_view_applies_fields_to_tag_query_and_streams(self, test_client, articles_db):
+        self.create_articles(test_client)
+
+        tagged = test_client.get('/v1/article/tag/wizard?fields=content').json()
+        assert [sorted(article) for article in tagged] == [['content', 'id']] * 2
+        # Full pages cached for the same tag are not returned for a sparse request, and vice versa
+        assert sorted(test_client.get('/v1/article/tag/wizard').json()[0]) == ['content', 'id', 'tags']
+
+        queried = test_client.get('/v1/article/query?any=owl&fields=tags&facets=true').json()
+        assert queried['articles'] == [{'id': queried['articles'][0]['id'], 'tags': ['wizard', 'owl']}]
+
+        lines = test_client.get('/v1/article?stream=ndjson&fields=tags').text.splitlines()
+        assert [sorted(json.loads(line)) for line in lines] == [['id', 'tags']] * 3
+
+    def test_view_counts_articles(self, test_client, articles_db):
+        self.create_articles(test_client)
+
+        assert test_client.get('/v1/article/count').json() == {'count': 3}
+        assert test_client.get('/v1/article/count?exact=true').json() == {'count': 3}
+        assert test_client.get('/v1/article/tag/wizard/count').json() == {'tag': 'wizard', 'count': 2}
+        assert test_client.get('/v1/article/tag/dragon/count').json() == {'tag': 'dragon', 'count': 0}
+
+
+class TestCompression:
+    def create_articles(self, test_client, count=50):
+        test_client.post(url='/v1/article/bulk', data=json.dumps([
+            {'content': f'Article {i} about wands, owls and potions', 'tags': ['wizard']} for i in range(count)
+        ]))
+
+    def test_negotiate_picks_the_preferred_accepted_encoding(self):
+        preference = ('zstd', 'br', 'gzip')
+        assert negotiate('gzip, deflate', preference) == 'gzip'
+        assert negotiate('gzip;q=0.5, br', preference) == 'br'
+        assert negotiate('br;q=0, gzip', preference) == 'gzip'
+        assert negotiate('*', preference) == 'zstd'
+        assert negotiate('identity', preference) is None
+        assert negotiate('', preference) is None
+
+    def test_view_compresses_large_responses(self, test_client, articles_db):
+        self.create_articles(test_client)
+
+        response = test_client.get('/v1/article', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['vary'] == 'Accept-Encoding'
+        assert int(response.headers['content-length']) < len(response.content)
+        assert len(response.json()) == 50
+        assert 'http_response_compression_saved_bytes_total{encoding="gzip"}' in test_client.get('/metrics').text
+
+    def test_view_skips_small_and_unaccepted_responses(self, test_client, articles_db):
+        self.create_articles(test_client, count=1)
+        assert 'content-encoding' not in test_client.get('/v1/article', headers={'Accept-Encoding': 'gzip'}).headers
+
+        self.create_articles(test_client)
+        assert 'content-encoding' not in test_client.get('/v1/article', headers={'Accept-Encoding': 'identity'}).headers
+
+    def test_view_compresses_with_brotli_and_zstd(self, test_client, articles_db):
+        self.create_articles(test_client)
+        decompress = {
+            'br': brotli.decompress,
+            'zstd': lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+        }
+
+        for encoding in ('br', 'zstd'):
+            response = test_client.get('/v1/article', headers={'Accept-Encoding': encoding}, stream=True)
+            assert response.headers['content-encoding'] == encoding
+            assert len(json.loads(decompress[encoding](response.raw.read(decode_content=False)))) == 50
+
+    def test_view_weakens_the_etag_of_compressed_responses(self, test_client, articles_db):
+        response = test_client.post(url='/v1/article', data=json.dumps({'content': 'owl ' * 500, 'tags': []}))
+        article_id = response.json()['id']
+
+        response = test_client.get(f'/v1/article/{article_id}', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['etag'] == 'W/"1"'
+        assert test_client.get(f'/v1/article/{article_id}', headers={'If-None-Match': 'W/"1"'}).status_code == 304
+        identity = test_client.get(f'/v1/article/{article_id}', headers={'Accept-Encoding': 'identity'})
+        assert identity.headers['etag'] == '"1"'
+
+    def test_view_compresses_streams_in_the_thread_pool(self, test_client, articles_db, monkeypatch):
+        monkeypatch.setattr(settings, 'compression_thread_threshold', 1)
+        self.create_articles(test_client)
+
+        response = test_client.get('/v1/article?stream=ndjson', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['content-encoding'] == 'gzip'
+        assert 'content-length' not in response.headers
+        assert len(response.text.splitlines()) == 50
+
+    def test_view_does_not_compress_gzip_exports_twice(self, test_client, articles_db):
+        self.create_articles(test_client)
+
+        response = test_client.get('/v1/article/export?compression=gzip', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'content-encoding' not in response.headers
+        assert len(gzip.decompress(response.content).splitlines()) == 50
+
+
+class TestTenants:
+    @fixture(autouse=True)
+    def tenants(self, test_client, monkeypatch):
+        """Route requests by tenant instead of to the test database"""
+        monkeypatch.setattr(settings, 'tenants', 'acme,globex')
+        monkeypatch.delitem(app.dependency_overrides, get_database)
+        # Tenants are prepared again on first use, their databases are dropped after each test
+        for attribute in ('tenants', 'databases', 'locks'):
+            monkeypatch.setattr(tenant_registry, attribute, {})
+        db_client = MongoClient(get_mongo_uri())
+        yield db_client
+        for name in ('articles_acme', 'articles_globex'):
+            db_client.drop_database(name)
+
+    def test_view_routes_by_header_and_path_prefix(self, test_client, tenants):
+        article = {'content': 'Article about owls', 'tags': ['owl']}
+        response = test_client.post(url='/v1/article', data=json.dumps(article), headers={'X-Tenant': 'acme'})
+        assert response.status_code == 200
+        assert test_client.post(url='/tenants/globex/v1/article', data=json.dumps(article)).status_code == 200
+
+        assert tenants['articles_acme'].articles.count_documents({}) == 1
+        assert tenants['articles_globex'].articles.count_documents({}) == 1
+        assert len(test_client.get('/v1/article', headers={'X-Tenant': 'acme'}).json()) == 1
+        assert len(test_client.get('/tenants/globex/v1/article/tag/owl').json()) == 1
+        test_client.delete('/tenants/globex/v1/article')
+        assert tenants['articles_acme'].articles.count_documents({}) == 1
+        assert tenants['articles_globex'].articles.count_documents({}) == 0
+
+    def test_view_points_tenant_jobs_at_the_tenant_prefix(self, test_client, tenants):
+        test_client.post(url='/tenants/acme/v1/article', data=json.dumps({'content': 'Article', 'tags': []}))
+
+        response = test_client.delete('/tenants/acme/v1/article?background=true')
+        assert response.status_code == 202
+        assert response.headers['location'].endswith(f'/tenants/acme/v1/jobs/{response.json()["id"]}')
+        for _ in range(100):
+            job = test_client.get(response.headers['location']).json()
+            if job['status'] not in ('queued', 'running'):
+                break
+        assert job['status'] == 'succeeded'
+        assert tenants['articles_acme'].articles.count_documents({}) == 0
+        # Jobs write through the tenant's cached handles and their write concerns
+        collections = tenant_registry.tenants['acme'].collections
+        assert {('jobs', 'writes'), ('articles', 'bulk'), ('tags', 'bulk')} <= set(collections)
+
+    def test_tag_counts_of_existing_articles_are_rebuilt_once(self, test_client, tenants, monkeypatch):
+        tenants['articles_acme'].articles.insert_many([
+            {'content': 'article1', 'tags': ['wizard']},
+            {'content': 'article2', 'tags': ['wizard', 'muggle']},
+        ])
+
+        jobs = test_client.get('/v1/jobs', headers={'X-Tenant': 'acme'}).json()
+        assert [job['type'] for job in jobs] == ['rebuild_tags']
+        for _ in range(100):
+            job = test_client.get(f'/v1/jobs/{jobs[0]["id"]}', headers={'X-Tenant': 'acme'}).json()
+            if job['status'] == 'succeeded':
+                break
+        response = test_client.get('/v1/tags?sort=popularity&counts=true', headers={'X-Tenant': 'acme'})
+        assert response.json() == [{'tag': 'wizard', 'count': 2}, {'tag': 'muggle', 'count': 1}]
+
+        # Workers started later find the migration recorded
+        monkeypatch.setattr(tenant_registry, 'tenants', {})
+        assert len(test_client.get('/v1/jobs', headers={'X-Tenant': 'acme'}).json()) == 1
+
+    def test_jobs_left_queued_or_stale_are_resumed_on_first_use(self, test_client, tenants, monkeypatch):
+        monkeypatch.setattr(job_runner, 'batch_delay', 0)
+        tenants['articles_acme'].articles.insert_many([
+            {'content': 'article1', 'tags': ['muggle']}, {'content': 'article2', 'tags': ['owl']},
+        ])
+        now = datetime.utcnow()
+        job_ids = tenants['articles_acme'].jobs.insert_many([
+            {'type': 'delete_articles', 'params': {'all': ['muggle']}, 'status': 'queued', 'updated_at': now},
+            # Left running by a worker which died
+            {'type': 'delete_articles', 'params': {'all': ['owl']}, 'status': 'running',
+             'updated_at': now - timedelta(seconds=settings.job_stale_after + 1)},
+            # Still running on another worker
+            {'type': 'delete_all', 'params': {}, 'status': 'running', 'updated_at': now},
+        ]).inserted_ids
+
+        statuses = []
+        for job_id in job_ids:
+            for _ in range(100):
+                job = test_client.get(f'/v1/jobs/{job_id}', headers={'X-Tenant': 'acme'}).json()
+                if job['status'] != 'queued':
+                    break
+            statuses.append(job['status'])
+        assert statuses == ['succeeded', 'succeeded', 'running']
+        assert tenants['articles_acme'].articles.count_documents({}) == 0
+
+    def test_view_rejects_unknown_tenants(self, test_client):
+        assert test_client.get('/v1/article', headers={'X-Tenant': 'initech'}).status_code == 404
+        assert test_client.get('/tenants/initech/v1/article').status_code == 404
+        assert test_client.get('/tenants//v1/article').status_code == 404
+
+    def test_view_answers_503_when_a_tenant_is_over_its_quota(self, test_client, monkeypatch):
+        quota = AdmissionLimiter('tenant', concurrency=1, queue_size=0, timeout=3)
+        quota.semaphore = asyncio.Semaphore(0)
+        monkeypatch.setitem(tenant_limiters, 'acme', quota)
+
+        response = test_client.get('/v1/article', headers={'X-Tenant': 'acme'})
+        assert response.status_code == 503
+        assert response.headers['retry-after'] == '3'
+        assert test_client.get('/v1/article', headers={'X-Tenant': 'globex'}).status_code == 200
+        assert 'tenant_rejected_total{reason="queue_full",tenant="acme"}' in test_client.get('/metrics').text
+
+    def test_collection_handles_are_created_once_per_tenant(self, test_client):
+        test_client.get('/v1/article', headers={'X-Tenant': 'acme'})
+        tenant = tenant_registry.tenants['acme']
+
+        collection = get_collection(tenant.database, 'articles', 'list')
+        assert get_collection(tenant.database, 'articles', 'list') is collection
+        assert get_collection(tenant.database, 'articles', 'writes') is not collection
+        assert tenant.database.name == 'articles_acme'
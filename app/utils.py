@@ -1,7 +1,116 @@
-def article_output(article: dict) -> dict:
-    """Cleans an article dictionary to convert ObjectIDs to str"""
+import base64
+import binascii
+from typing import Any, AsyncIterator, List, Optional, Sequence, Tuple
+
+import orjson
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi.responses import ORJSONResponse
+from motor.motor_asyncio import AsyncIOMotorCursor
+
+from .models import Article
+
+# Only fetch the fields article_output needs from MongoDB
+ARTICLE_PROJECTION = {'content': True, 'tags': True}
+ARTICLE_FIELDS = ('id', 'content', 'tags')
+FIELDS_PATTERN = '^(id|content|tags)(,(id|content|tags))*$'
+
+
+def parse_fields(fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """Splits a comma separated fields parameter, None selects every field"""
+    if fields is None:
+        return None
+    return tuple(field for field in ARTICLE_FIELDS if field in fields.split(','))
+
+
+def article_projection(fields: Optional[Sequence[str]] = None) -> dict:
+    """Returns the projection fetching only the selected fields, the id is always included"""
+    if fields is None:
+        return ARTICLE_PROJECTION
+    return {'_id': True, **{field: True for field in fields if field != 'id'}}
+
+
+def article_output(article: dict, fields: Optional[Sequence[str]] = None) -> dict:
+    """Cleans an article dictionary, its ObjectID is converted to str when serialized"""
+    if fields is not None:
+        return {'id': article['_id'], **{field: article[field] for field in fields if field != 'id'}}
     return {
-        'id': str(article['_id']),
+        'id': article['_id'],
         'content': article['content'],
         'tags': article['tags']
     }
+
+
+def article_document(article: Article) -> dict:
+    """Creates the document stored for a new article, starting at version 1"""
+    return {**article.dict(), 'version': 1}
+
+
+def article_etag(article: dict) -> str:
+    """Returns the ETag of an article's version, articles saved without a version are at version 0"""
+    return f'"{article.get("version", 0)}"'
+
+
+def parse_etags(header: Optional[str]) -> List[str]:
+    """Splits an If-Match or If-None-Match header into its ETags, ignoring weak validator prefixes"""
+    if header is None:
+        return []
+    return [etag.strip()[2:] if etag.strip().startswith('W/') else etag.strip() for etag in header.split(',')]
+
+
+def etag_versions(etags: List[str]) -> List[Optional[int]]:
+    """Converts ETags back into article versions, version 0 also matches articles saved without one"""
+    versions = []
+    for etag in etags:
+        try:
+            versions.append(int(etag.strip('"')))
+        except ValueError:
+            continue
+    return versions + [None] if 0 in versions else versions
+
+
+def encode_object_id(value: Any) -> str:
+    """Encodes ObjectIDs for orjson, which doesn't know about BSON types"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError
+
+
+def dumps(content: Any) -> bytes:
+    """Serializes content to JSON with orjson, converting ObjectIDs to str on the way"""
+    return orjson.dumps(content, default=encode_object_id)
+
+
+class ArticleJSONResponse(ORJSONResponse):
+    """orjson response which also encodes ObjectIDs, return it directly to skip jsonable_encoder"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def encode_cursor(article_id: ObjectId) -> str:
+    """Encodes an article ObjectID into an opaque pagination cursor"""
+    return base64.urlsafe_b64encode(article_id.binary).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> ObjectId:
+    """Decodes a pagination cursor back into an ObjectID, raises ValueError if the cursor is invalid"""
+    try:
+        return ObjectId(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, InvalidId, TypeError) as error:
+        raise ValueError(f'Invalid cursor: {cursor}') from error
+
+
+async def stream_articles(cursor: AsyncIOMotorCursor, stream_format: str,
+                          fields: Optional[Sequence[str]] = None) -> AsyncIterator[bytes]:
+    """Serializes articles one by one as they come off the DB cursor, as NDJSON or a JSON array"""
+    if stream_format == 'ndjson':
+        async for article in cursor:
+            yield dumps(article_output(article, fields)) + b'\n'
+        return
+
+    separator = b'['
+    async for article in cursor:
+        yield separator + dumps(article_output(article, fields))
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
@@ -1,66 +1,400 @@
+import json
+from typing import List, Optional, Tuple
+
 from bson import ObjectId
-from fastapi import APIRouter, Response, Depends
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Response, Depends, Header, Query, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from pymongo import ASCENDING, DESCENDING, ReturnDocument
+from pymongo.errors import OperationFailure
 
+from .admission import admit
+from .bulk import ArticleImporter, BulkInserter, articles_inserted, export_articles, gunzip, iter_ndjson
+from .cache import article_cache, invalidate_article, invalidate_database
+from .coalescing import insert_batcher
+from .config import settings
 from .database import AsyncIOMotorClient, get_database
-from .models import Article
-from .utils import article_output
+from .jobs import job_output, job_runner
+from .models import Article, Job
+from .search import drop_search_index, get_search_index, index_article, remove_article
+from .tags import apply_tag_delta, drop_tag_index, get_tag_index, tag_delta, tag_query
+from .tenants import get_collection
+from .utils import (ARTICLE_PROJECTION, FIELDS_PATTERN, ArticleJSONResponse, article_document, article_etag,
+                    article_output, article_projection, decode_cursor, encode_cursor, etag_versions, parse_etags,
+                    parse_fields, stream_articles)
+
+router = APIRouter(default_response_class=ArticleJSONResponse)
+
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+STREAM_MEDIA_TYPES = {'ndjson': 'application/x-ndjson', 'json': 'application/json'}
+BULK_CHUNK_SIZE = 1000
+MAX_BULK_CHUNK_SIZE = 10000
+FACET_SIZE = 50
+SUGGEST_SIZE = 10
+MAX_SUGGEST_SIZE = 100
+EXPORT_BATCH_SIZE = 1000
+TEXT_INDEX_NOT_FOUND = 27
+
+
+def split_page(articles: List[dict], limit: int,
+               fields: Optional[Tuple[str, ...]] = None) -> Tuple[List[dict], Optional[str]]:
+    """Trims the extra article fetched past limit and returns the cursor of the next page, if any"""
+    next_cursor = None
+    if len(articles) > limit:
+        articles = articles[:limit]
+        next_cursor = encode_cursor(articles[-1]['_id'])
+    return [article_output(article, fields) for article in articles], next_cursor
+
+
+def invalid_cursor(after: str, error: ValueError) -> JSONResponse:
+    return JSONResponse(status_code=400, content={'cursor': after, 'message': str(error)})
+
+
+async def find_article_page(collection, query: dict, limit: int,
+                            fields: Optional[Tuple[str, ...]] = None) -> Tuple[List[dict], Optional[str]]:
+    """Returns up to limit articles sorted by _id and the cursor of the next page, if any"""
+    cursor = collection.find(query, article_projection(fields)).sort('_id', ASCENDING).limit(limit + 1)
+    return split_page(await cursor.to_list(length=limit + 1), limit, fields)
+
+
+async def find_articles(collection, query: dict, limit: Optional[int], after: Optional[str], stream: Optional[str],
+                        cache_key: tuple = None, fields: Optional[Tuple[str, ...]] = None):
+    """Returns one keyset page of articles sorted by _id, or streams every matching article.
+
+    Only the selected fields are fetched and returned, pages are cached under cache_key when one is given.
+    """
+    if after is not None:
+        try:
+            query = {**query, '_id': {'$gt': decode_cursor(after)}}
+        except ValueError as error:
+            return invalid_cursor(after, error)
 
-router = APIRouter()
+    if stream is not None:
+        cursor = collection.find(query, article_projection(fields)).sort('_id', ASCENDING)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+        cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+        return StreamingResponse(stream_articles(cursor, stream, fields), media_type=STREAM_MEDIA_TYPES[stream])
 
+    limit = limit or PAGE_SIZE
+    page = article_cache.get(cache_key + (limit, after, fields)) if cache_key else None
+    if page is None:
+        generation = article_cache.generation(cache_key[1]) if cache_key else None
+        page = await find_article_page(collection, query, limit, fields)
+        if cache_key:
+            article_cache.set_unless_invalidated(cache_key + (limit, after, fields), page, generation)
 
-@router.post('/article')
+    articles, next_cursor = page
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else None
+    return ArticleJSONResponse(articles, headers=headers)
+
+
+@router.post('/article', dependencies=[Depends(admit('writes'))])
 async def create_article(article: Article, db: AsyncIOMotorClient = Depends(get_database)):
-    result = await db['articles'].insert_one(article.dict())
-    return {'id': str(result.inserted_id), **article.dict()}
+    document = article_document(article)
+    if insert_batcher.enabled:
+        await insert_batcher.insert(db, document)
+    else:
+        await get_collection(db, 'articles', 'writes').insert_one(document)
+        await articles_inserted(db, [document])
+    return ArticleJSONResponse(article_output(document), headers={'ETag': article_etag(document)})
+
+
+@router.post('/article/bulk', dependencies=[Depends(admit('bulk'))])
+async def create_articles_in_bulk(request: Request,
+                                  chunk_size: int = Query(BULK_CHUNK_SIZE, ge=1, le=MAX_BULK_CHUNK_SIZE),
+                                  db: AsyncIOMotorClient = Depends(get_database)):
+    inserter = BulkInserter(db, chunk_size)
+    if request.headers.get('content-type', '').startswith('application/x-ndjson'):
+        index = 0
+        async for line in iter_ndjson(request.stream()):
+            await inserter.add_line(index, line)
+            index += 1
+    else:
+        try:
+            items = json.loads(await request.body())
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            return JSONResponse(status_code=422, content={'message': 'Expected a JSON array or NDJSON stream of articles'})
+        for index, item in enumerate(items):
+            await inserter.add(index, item)
+    await inserter.flush()
+    return inserter.summary()
+
+
+@router.get('/article/export', dependencies=[Depends(admit('bulk'))])
+async def export_all_articles(after: Optional[str] = None,
+                              compression: Optional[str] = Query(None, regex='^gzip$'),
+                              db: AsyncIOMotorClient = Depends(get_database)):
+    query = {}
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            return JSONResponse(status_code=400, content={'after': after, 'message': f'Invalid article ID: {after}'})
+        query['_id'] = {'$gt': ObjectId(after)}
+
+    cursor = get_collection(db, 'articles', 'list').find(query, {**ARTICLE_PROJECTION, 'version': True})
+    cursor = cursor.sort('_id', ASCENDING)
+    cursor = cursor.batch_size(EXPORT_BATCH_SIZE)
+    if compression == 'gzip':
+        return StreamingResponse(
+            export_articles(cursor, compress=True),
+            media_type='application/gzip',
+            headers={'Content-Disposition': 'attachment; filename="articles.ndjson.gz"'},
+        )
+    return StreamingResponse(export_articles(cursor, compress=False), media_type='application/x-ndjson')
+
+
+@router.post('/article/import', dependencies=[Depends(admit('bulk'))])
+async def import_articles(request: Request,
+                          after: Optional[str] = None,
+                          chunk_size: int = Query(BULK_CHUNK_SIZE, ge=1, le=MAX_BULK_CHUNK_SIZE),
+                          db: AsyncIOMotorClient = Depends(get_database)):
+    if after is not None and not ObjectId.is_valid(after):
+        return JSONResponse(status_code=400, content={'after': after, 'message': f'Invalid article ID: {after}'})
+
+    importer = ArticleImporter(db, chunk_size, after=ObjectId(after) if after is not None else None)
+    body = request.stream()
+    if request.headers.get('content-encoding', '').lower() == 'gzip':
+        body = gunzip(body)
+    index = 0
+    async for line in iter_ndjson(body):
+        await importer.add_line(index, line)
+        index += 1
+    await importer.flush()
+    return importer.summary()
+
 
+@router.get('/article', dependencies=[Depends(admit('reads'))])
+async def get_all_articles(limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                           after: Optional[str] = None,
+                           stream: Optional[str] = Query(None, regex='^(ndjson|json)$'),
+                           fields: Optional[str] = Query(None, regex=FIELDS_PATTERN),
+                           db: AsyncIOMotorClient = Depends(get_database)):
+    articles = get_collection(db, 'articles', 'list')
+    return await find_articles(articles, {}, limit, after, stream, fields=parse_fields(fields))
 
-@router.get('/article')
-async def get_all_articles(db: AsyncIOMotorClient = Depends(get_database)):
-    return [article_output(article) async for article in db['articles'].find()]
 
+@router.get('/article/count', dependencies=[Depends(admit('reads'))])
+async def count_all_articles(exact: bool = False, db: AsyncIOMotorClient = Depends(get_database)):
+    articles = get_collection(db, 'articles', 'list')
+    # The estimate comes from collection metadata, an exact count walks the _id index
+    count = await articles.count_documents({}) if exact else await articles.estimated_document_count()
+    return ArticleJSONResponse({'count': count})
 
-@router.delete('/article')
-async def delete_all_articles(db: AsyncIOMotorClient = Depends(get_database)):
-    await db['articles'].delete_many({})
+
+@router.delete('/article', dependencies=[Depends(admit('admin'))])
+async def delete_all_articles(request: Request, background: bool = False,
+                              db: AsyncIOMotorClient = Depends(get_database)):
+    if background:
+        # Drops and recreates the collections in a job instead of deleting every document in the request
+        return await submit_job(request, Job(type='delete_all'), db)
+    await get_collection(db, 'articles', 'bulk').delete_many({})
+    await get_collection(db, 'tags', 'bulk').delete_many({})
+    await invalidate_database(db)
+    drop_search_index(db)
+    drop_tag_index(db)
     return Response(status_code=204)
 
 
-@router.get('/article/{id}')
-async def get_single_article(id: str, db: AsyncIOMotorClient = Depends(get_database)):
-    article = await db['articles'].find_one({'_id': ObjectId(id)})
-    if article is not None:
-        return article_output(article)
-    return JSONResponse(status_code=404, content={'id': id, 'message': f'article with ID {id} not found'})
+@router.get('/article/query', dependencies=[Depends(admit('reads'))])
+async def query_articles(all_tags: List[str] = Query([], alias='all'),
+                         any_tags: List[str] = Query([], alias='any'),
+                         no_tags: List[str] = Query([], alias='none'),
+                         facets: bool = False,
+                         limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                         after: Optional[str] = None,
+                         stream: Optional[str] = Query(None, regex='^(ndjson|json)$'),
+                         fields: Optional[str] = Query(None, regex=FIELDS_PATTERN),
+                         db: AsyncIOMotorClient = Depends(get_database)):
+    query = tag_query(all_tags, any_tags, no_tags)
+    if not query:
+        return JSONResponse(status_code=422, content={'message': 'At least one of all, any or none is required'})
+    fields = parse_fields(fields)
+    if not facets:
+        return await find_articles(get_collection(db, 'articles', 'list'), query, limit, after, stream, fields=fields)
+    if stream is not None:
+        return JSONResponse(status_code=422, content={'message': 'Facets cannot be streamed'})
 
+    try:
+        page_query = {'_id': {'$gt': decode_cursor(after)}} if after is not None else {}
+    except ValueError as error:
+        return invalid_cursor(after, error)
 
-@router.put('/article/{id}')
-async def update_single_article(id: str, new_article: Article, db: AsyncIOMotorClient = Depends(get_database)):
-    article = await db['articles'].find_one({'_id': ObjectId(id)})
-    if article is not None:
-        await db['articles'].update_one(
-            filter={'_id': article['_id']},
-            update={'$set': {'content': new_article.content, 'tags': new_article.tags}}
+    # One aggregation returns the page and the co-occurring tag counts over every match
+    limit = limit or PAGE_SIZE
+    pipeline = [
+        {'$match': query},
+        {'$facet': {
+            'articles': [
+                {'$match': page_query},
+                {'$sort': {'_id': 1}},
+                {'$limit': limit + 1},
+                {'$project': article_projection(fields)},
+            ],
+            'facets': [
+                {'$unwind': '$tags'},
+                {'$match': {'tags': {'$nin': all_tags}}},
+                {'$group': {'_id': '$tags', 'count': {'$sum': 1}}},
+                {'$sort': {'count': -1, '_id': 1}},
+                {'$limit': FACET_SIZE},
+            ],
+        }},
+    ]
+    result = (await get_collection(db, 'articles', 'list').aggregate(pipeline).to_list(length=1))[0]
+    articles, next_cursor = split_page(result['articles'], limit, fields)
+    headers = {'X-Next-Cursor': next_cursor} if next_cursor is not None else None
+    return ArticleJSONResponse({
+        'articles': articles,
+        'facets': [{'tag': facet['_id'], 'count': facet['count']} for facet in result['facets']],
+    }, headers=headers)
+
+
+@router.get('/article/search', dependencies=[Depends(admit('reads'))])
+async def search_articles(q: str = Query(..., min_length=1),
+                          tags: List[str] = Query([]),
+                          limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          offset: int = Query(0, ge=0),
+                          db: AsyncIOMotorClient = Depends(get_database)):
+    query = {'tags': {'$all': tags}} if tags else {}
+    articles = get_collection(db, 'articles', 'list')
+    if settings.search_backend != 'memory':
+        try:
+            cursor = articles.find(
+                {**query, '$text': {'$search': q}},
+                {**ARTICLE_PROJECTION, 'score': {'$meta': 'textScore'}},
+            ).sort([('score', {'$meta': 'textScore'})]).skip(offset).limit(limit)
+            return ArticleJSONResponse([{**article_output(article), 'score': article['score']} async for article in cursor])
+        except OperationFailure as error:
+            # Fall back to the in-memory index when the text index doesn't exist
+            if settings.search_backend == 'text' or error.code != TEXT_INDEX_NOT_FOUND:
+                raise
+
+    search_index = await get_search_index(db)
+    matches = [(ObjectId(article_id), score) for article_id, score in search_index.search(q, tags)[offset:offset + limit]]
+    cursor = articles.find({'_id': {'$in': [article_id for article_id, _ in matches]}}, ARTICLE_PROJECTION)
+    found = {article['_id']: article async for article in cursor}
+    return ArticleJSONResponse([
+        {**article_output(found[article_id]), 'score': score} for article_id, score in matches if article_id in found
+    ])
+
+
+@router.get('/article/{id}', dependencies=[Depends(admit('reads'))])
+async def get_single_article(id: str, if_none_match: Optional[str] = Header(None),
+                             db: AsyncIOMotorClient = Depends(get_database)):
+    # ObjectId hex is case-insensitive, the key uses the lowercase form which writes invalidate
+    cache_key = ('article', db.name, str(ObjectId(id)))
+    cached = article_cache.get(cache_key)
+    if cached is None:
+        generation = article_cache.generation(db.name)
+        article = await get_collection(db, 'articles', 'single').find_one(
+            {'_id': ObjectId(id)}, {**ARTICLE_PROJECTION, 'version': True},
         )
-        return {'id': id, **new_article.dict()}
+        if article is None:
+            return JSONResponse(status_code=404, content={'id': id, 'message': f'article with ID {id} not found'})
+        cached = (article_output(article), article_etag(article))
+        article_cache.set_unless_invalidated(cache_key, cached, generation)
+
+    article, etag = cached
+    if etag in parse_etags(if_none_match) or if_none_match == '*':
+        return Response(status_code=304, headers={'ETag': etag})
+    return ArticleJSONResponse(article, headers={'ETag': etag})
+
+
+@router.put('/article/{id}', dependencies=[Depends(admit('writes'))])
+async def update_single_article(id: str, new_article: Article, if_match: Optional[str] = Header(None),
+                                db: AsyncIOMotorClient = Depends(get_database)):
+    query = {'_id': ObjectId(id)}
+    if if_match is not None and if_match.strip() != '*':
+        query['version'] = {'$in': etag_versions(parse_etags(if_match))}
+
+    document = new_article.dict()
+    articles = get_collection(db, 'articles', 'writes')
+    article = await articles.find_one_and_update(
+        filter=query,
+        update={'$set': document, '$inc': {'version': 1}},
+        projection={'tags': True, 'version': True},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if article is not None:
+        await apply_tag_delta(db, tag_delta(article['tags'], new_article.tags))
+        await invalidate_article(db, str(query['_id']), article['tags'] + new_article.tags)
+        index_article(db, str(query['_id']), new_article.content, new_article.tags)
+        etag = article_etag({'version': article.get('version', 0) + 1})
+        return ArticleJSONResponse({'id': id, **document}, headers={'ETag': etag})
+    if 'version' in query and await articles.count_documents({'_id': query['_id']}, limit=1):
+        return JSONResponse(status_code=412, content={'id': id, 'message': f'article with ID {id} has been modified'})
     return JSONResponse(status_code=404, content={'id': id, 'message': f'article with ID {id} not found'})
 
 
-@router.delete('/article/{id}')
+@router.delete('/article/{id}', dependencies=[Depends(admit('writes'))])
 async def delete_single_article(id: str, db: AsyncIOMotorClient = Depends(get_database)):
-    article = await db['articles'].find_one({'_id': ObjectId(id)})
+    articles = get_collection(db, 'articles', 'writes')
+    article = await articles.find_one_and_delete({'_id': ObjectId(id)}, projection={'tags': True})
     if article is not None:
-        await db['articles'].delete_one({'_id': article['_id']})
+        await apply_tag_delta(db, tag_delta(old_tags=article['tags']))
+        await invalidate_article(db, str(article['_id']), article['tags'])
+        remove_article(db, str(article['_id']))
         return Response(status_code=204)
     return JSONResponse(status_code=404, content={'id': id, 'message': f'article with ID {id} not found'})
 
 
-@router.get('/article/tag/{tag}')
-async def get_all_articles_with_tag(tag: str, db: AsyncIOMotorClient = Depends(get_database)):
+@router.get('/article/tag/{tag}', dependencies=[Depends(admit('reads'))])
+async def get_all_articles_with_tag(tag: str,
+                                    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                                    after: Optional[str] = None,
+                                    stream: Optional[str] = Query(None, regex='^(ndjson|json)$'),
+                                    fields: Optional[str] = Query(None, regex=FIELDS_PATTERN),
+                                    db: AsyncIOMotorClient = Depends(get_database)):
     query = {'tags': {'$elemMatch': {'$eq': tag}}}
-    return [article_output(article) async for article in db['articles'].find(query)]
+    articles = get_collection(db, 'articles', 'list')
+    return await find_articles(articles, query, limit, after, stream, ('tag', db.name, tag), parse_fields(fields))
+
+
+@router.get('/article/tag/{tag}/count', dependencies=[Depends(admit('reads'))])
+async def count_articles_with_tag(tag: str, db: AsyncIOMotorClient = Depends(get_database)):
+    # Counted on the tags_id index without fetching any article
+    count = await get_collection(db, 'articles', 'list').count_documents({'tags': tag})
+    return ArticleJSONResponse({'tag': tag, 'count': count})
+
+
+@router.get('/tags', dependencies=[Depends(admit('reads'))])
+async def get_all_tags(sort: str = Query('name', regex='^(name|popularity)$'), counts: bool = False,
+                       db: AsyncIOMotorClient = Depends(get_database)):
+    order = [('count', DESCENDING), ('_id', ASCENDING)] if sort == 'popularity' else [('_id', ASCENDING)]
+    tags = get_collection(db, 'tags', 'list').find({}, sort=order)
+    if counts:
+        return ArticleJSONResponse([{'tag': tag['_id'], 'count': tag['count']} async for tag in tags])
+    return ArticleJSONResponse([tag['_id'] async for tag in tags])
+
+
+@router.get('/tags/suggest', dependencies=[Depends(admit('reads'))])
+async def suggest_tags(prefix: str = '', limit: int = Query(SUGGEST_SIZE, ge=1, le=MAX_SUGGEST_SIZE),
+                       db: AsyncIOMotorClient = Depends(get_database)):
+    index = await get_tag_index(db)
+    return ArticleJSONResponse([{'tag': tag, 'count': count} for tag, count in index.suggest(prefix, limit)])
+
+
+@router.post('/jobs', dependencies=[Depends(admit('admin'))])
+async def submit_job(request: Request, job: Job, db: AsyncIOMotorClient = Depends(get_database)):
+    document = await job_runner.submit(db, job)
+    # url_for keeps the root path, so jobs of a /tenants/<tenant> request are polled under the same prefix
+    location = request.url_for('get_single_job', id=str(document['_id']))
+    return ArticleJSONResponse(job_output(document), status_code=202, headers={'Location': location})
+
+
+@router.get('/jobs', dependencies=[Depends(admit('reads'))])
+async def get_recent_jobs(limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+                          db: AsyncIOMotorClient = Depends(get_database)):
+    jobs = get_collection(db, 'jobs', 'list').find({}).sort('_id', DESCENDING).limit(limit)
+    return ArticleJSONResponse([job_output(job) async for job in jobs])
 
 
-@router.get('/tags')
-async def get_all_tags(db: AsyncIOMotorClient = Depends(get_database)):
-    return await db['articles'].distinct('tags', {})
+@router.get('/jobs/{id}', dependencies=[Depends(admit('reads'))])
+async def get_single_job(id: str, db: AsyncIOMotorClient = Depends(get_database)):
+    jobs = get_collection(db, 'jobs', 'single')
+    job = await jobs.find_one({'_id': ObjectId(id)}) if ObjectId.is_valid(id) else None
+    if job is None:
+        return JSONResponse(status_code=404, content={'id': id, 'message': f'job with ID {id} not found'})
+    return ArticleJSONResponse(job_output(job))
@@ -0,0 +1,261 @@
+"""Load test of every /v1 endpoint, driven concurrently through the ASGI app.
+
+Seeds a dataset, fires requests at each endpoint with an async HTTP client and reports
+req/s and p50/p95/p99 latencies. Results can be saved as a baseline and later runs compared
+against it to flag regressions.
+
+Run against the MongoDB configured in .env with:
+    python -m benchmarks.loadtest --articles 10000 --save benchmarks/baselines/main.json
+    python -m benchmarks.loadtest --articles 10000 --compare benchmarks/baselines/main.json
+
+Both need the packages of requirements-dev.txt. The in-memory stand-in, selected with --backend memory, has no $text
+support so search is served by the in-memory search index.
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+from bson import ObjectId
+
+from app.config import settings
+from app.database import db, get_database, get_tenant, shutdown_db_client, startup_db_client
+from app.indexes import ensure_indexes
+from app.jobs import job_runner
+from app.main import app
+from app.tags import rebuild_tag_counts
+from app.tenants import DEFAULT_TENANT, Tenant
+
+WORDS = ['wand', 'owl', 'potion', 'broom', 'letter', 'castle', 'dragon', 'cloak', 'feast', 'quidditch']
+
+# Endpoint name -> request factory returning (method, url, request kwargs)
+Request = Tuple[str, str, dict]
+
+# Exports stream this many of the newest articles, so a run's cost doesn't grow with the dataset
+EXPORT_ARTICLES = 1000
+
+
+def seed_documents(count: int, tags_per_article: int, tag_vocabulary: int, content_size: int,
+                   rng: random.Random) -> List[dict]:
+    """Builds reproducible articles, tags follow a skewed distribution so some are hot"""
+    weights = [1 / (rank + 1) for rank in range(tag_vocabulary)]
+    documents = []
+    for _ in range(count):
+        tags = set(rng.choices(range(tag_vocabulary), weights=weights, k=tags_per_article))
+        words = []
+        while sum(len(word) + 1 for word in words) < content_size:
+            words.append(rng.choice(WORDS))
+        documents.append({
+            '_id': ObjectId(),
+            'content': ' '.join(words),
+            'tags': [f'tag{tag}' for tag in sorted(tags)],
+            'version': 1,
+        })
+    return documents
+
+
+async def seed(database, args, rng: random.Random) -> Tuple[List[ObjectId], List[ObjectId], ObjectId]:
+    """Replaces the benchmark database's articles and jobs, returns ids to read, ids to delete and a job id"""
+    await database['articles'].delete_many({})
+    await database['jobs'].delete_many({})
+    await ensure_indexes(database)
+    documents = seed_documents(args.articles, args.tags_per_article, args.tag_vocabulary, args.content_size, rng)
+    for start in range(0, len(documents), 1000):
+        await database['articles'].insert_many(documents[start:start + 1000], ordered=False)
+    await rebuild_tag_counts(database)
+    # A finished job for GET /jobs/{id}, submitted jobs are benchmarked by POST /jobs
+    job = {'_id': ObjectId(), 'type': 'rebuild_tags', 'params': {}, 'status': 'succeeded', 'processed': len(documents),
+           'total': len(documents), 'error': None}
+    await database['jobs'].insert_one(job)
+
+    ids = [document['_id'] for document in documents]
+    deletable = ids[:args.requests]
+    return ids[args.requests:] or ids, deletable, job['_id']
+
+
+def endpoints(ids: List[ObjectId], deletable: List[ObjectId], job_id: ObjectId, args,
+              rng: random.Random) -> Dict[str, Callable[[], Request]]:
+    """Request factories for every /v1 endpoint except DELETE /v1/article, which would wipe the dataset"""
+    hot_tags = [f'tag{tag}' for tag in range(min(10, args.tag_vocabulary))]
+    new_article = lambda: {'content': ' '.join(rng.choices(WORDS, k=20)), 'tags': rng.sample(hot_tags, 2)}
+    ndjson = lambda: ''.join(json.dumps(new_article()) + '\n' for _ in range(100)).encode()
+    export_after = str(ids[-min(EXPORT_ARTICLES, len(ids))])
+    deletable = iter(deletable)
+
+    return {
+        'POST /article': lambda: ('POST', '/v1/article', {'json': new_article()}),
+        'POST /article/bulk': lambda: ('POST', '/v1/article/bulk', {'json': [new_article() for _ in range(100)]}),
+        'GET /article': lambda: ('GET', '/v1/article', {'params': {'limit': 100}}),
+        'GET /article?stream': lambda: ('GET', '/v1/article', {'params': {'stream': 'ndjson', 'limit': 1000}}),
+        'GET /article/query': lambda: ('GET', '/v1/article/query', {
+            'params': {'all': rng.choice(hot_tags), 'facets': 'true', 'limit': 50}
+        }),
+        'GET /article/search': lambda: ('GET', '/v1/article/search', {'params': {'q': rng.choice(WORDS), 'limit': 20}}),
+        'GET /article/{id}': lambda: ('GET', f'/v1/article/{rng.choice(ids)}', {}),
+        'PUT /article/{id}': lambda: ('PUT', f'/v1/article/{rng.choice(ids)}', {'json': new_article()}),
+        'DELETE /article/{id}': lambda: ('DELETE', f'/v1/article/{next(deletable)}', {}),
+        'GET /article/count': lambda: ('GET', '/v1/article/count', {}),
+        'GET /article/count?exact': lambda: ('GET', '/v1/article/count', {'params': {'exact': 'true'}}),
+        'GET /article/export': lambda: ('GET', '/v1/article/export', {'params': {'after': export_after}}),
+        'POST /article/import': lambda: ('POST', '/v1/article/import', {
+            'content': ndjson(), 'headers': {'Content-Type': 'application/x-ndjson'}
+        }),
+        'GET /article/tag/{tag}': lambda: ('GET', f'/v1/article/tag/{rng.choice(hot_tags)}', {'params': {'limit': 100}}),
+        'GET /article/tag/{tag}/count': lambda: ('GET', f'/v1/article/tag/{rng.choice(hot_tags)}/count', {}),
+        'GET /tags': lambda: ('GET', '/v1/tags', {}),
+        'GET /tags?popularity': lambda: ('GET', '/v1/tags', {'params': {'sort': 'popularity', 'counts': 'true'}}),
+        'GET /tags/suggest': lambda: ('GET', '/v1/tags/suggest', {'params': {'prefix': f'tag{rng.randrange(10)}'}}),
+        # Renames a tag no article has, so submitting jobs doesn't change the dataset under the other endpoints
+        'POST /jobs': lambda: ('POST', '/v1/jobs', {
+            'json': {'type': 'rename_tag', 'source': 'loadtest-source', 'target': 'loadtest-target'}
+        }),
+        'GET /jobs': lambda: ('GET', '/v1/jobs', {}),
+        'GET /jobs/{id}': lambda: ('GET', f'/v1/jobs/{job_id}', {}),
+    }
+
+
+def percentile(latencies: List[float], fraction: float) -> float:
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def drive(client: httpx.AsyncClient, make_request: Callable[[], Request], requests: int, concurrency: int) -> dict:
+    """Sends requests from concurrent workers and returns throughput and latency percentiles in ms"""
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, url, kwargs = make_request()
+            started = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                await response.aread()
+            except Exception:
+                # The ASGI transport re-raises unhandled app errors, count them instead of aborting the run
+                errors += 1
+            else:
+                if response.status_code >= 400:
+                    errors += 1
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'errors': errors,
+        'rps': requests / elapsed,
+        'p50': statistics.median(latencies),
+        'p95': percentile(latencies, 0.95),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Lists endpoints whose throughput dropped or p95 latency rose by more than threshold"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if result['rps'] < previous['rps'] * (1 - threshold):
+            regressions.append(f'{name}: {result["rps"]:.1f} req/s, baseline {previous["rps"]:.1f} req/s')
+        if result['p95'] > previous['p95'] * (1 + threshold):
+            regressions.append(f'{name}: p95 {result["p95"]:.2f} ms, baseline {previous["p95"]:.2f} ms')
+    return regressions
+
+
+async def run(args) -> Dict[str, dict]:
+    rng = random.Random(args.seed)
+    if args.backend == 'memory':
+        from mongomock_motor import AsyncCursor, AsyncMongoMockClient
+        if not hasattr(AsyncCursor, 'batch_size'):
+            # Only a network hint, mongomock-motor releases compatible with motor 2.3 don't chain it
+            AsyncCursor.batch_size = lambda cursor, size: cursor
+        db.client = AsyncMongoMockClient()
+        settings.search_backend = 'memory'
+    else:
+        await startup_db_client()
+    database = db.client[args.db]
+
+    async def override_get_database():
+        yield database
+
+    async def override_get_tenant():
+        # Admission quotas apply, without creating the default tenant's database
+        return tenant
+
+    tenant = Tenant(DEFAULT_TENANT, db.client)
+    app.dependency_overrides[get_database] = override_get_database
+    app.dependency_overrides[get_tenant] = override_get_tenant
+    try:
+        ids, deletable, job_id = await seed(database, args, rng)
+        results = {}
+        async with httpx.AsyncClient(app=app, base_url='http://loadtest') as client:
+            for name, make_request in endpoints(ids, deletable, job_id, args, rng).items():
+                if args.endpoint and not any(pattern in name for pattern in args.endpoint):
+                    continue
+                results[name] = await drive(client, make_request, args.requests, args.concurrency)
+                result = results[name]
+                print(f'{name:<28} {result["rps"]:9.1f} req/s  p50 {result["p50"]:8.2f} ms  '
+                      f'p95 {result["p95"]:8.2f} ms  p99 {result["p99"]:8.2f} ms  errors {result["errors"]}')
+        return results
+    finally:
+        app.dependency_overrides.pop(get_database, None)
+        app.dependency_overrides.pop(get_tenant, None)
+        if args.backend == 'memory':
+            await job_runner.close()
+            db.client = None
+        else:
+            for name in ('articles', 'tags', 'jobs'):
+                await database[name].delete_many({})
+            await shutdown_db_client()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.loadtest')
+    parser.add_argument('--backend', choices=['mongo', 'memory'], default='mongo')
+    parser.add_argument('--db', default='benchmark_articles', help='database seeded and emptied by the run')
+    parser.add_argument('--articles', type=int, default=10000)
+    parser.add_argument('--tags-per-article', type=int, default=3)
+    parser.add_argument('--tag-vocabulary', type=int, default=200)
+    parser.add_argument('--content-size', type=int, default=500)
+    parser.add_argument('--requests', type=int, default=500, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--endpoint', action='append', help='only run endpoints whose name contains this')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', type=Path, help='save the results as a baseline JSON file')
+    parser.add_argument('--compare', type=Path, help='compare the results against a baseline JSON file')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression (default: 0.2 = 20%%)')
+    args = parser.parse_args()
+    if args.articles <= args.requests:
+        parser.error('--articles must be larger than --requests, DELETE /article/{id} consumes one article per request')
+
+    results = asyncio.run(run(args))
+
+    if args.save:
+        args.save.parent.mkdir(parents=True, exist_ok=True)
+        config = {key: value for key, value in vars(args).items() if key not in ('save', 'compare', 'endpoint')}
+        args.save.write_text(json.dumps({'config': config, 'endpoints': results}, indent=2))
+        print(f'Baseline saved to {args.save}')
+
+    if args.compare:
+        regressions = compare(results, json.loads(args.compare.read_text())['endpoints'], args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()
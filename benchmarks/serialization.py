@@ -0,0 +1,56 @@
+"""Microbenchmark of the per-document cost of serializing a large list response.
+
+Run with: python -m benchmarks.serialization --documents 10000
+"""
+import argparse
+import timeit
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from app.utils import ArticleJSONResponse, article_output
+
+
+def make_articles(documents: int, content_size: int, tags: int) -> list:
+    """Builds articles the way they come off a Motor cursor"""
+    return [
+        {'_id': ObjectId(), 'content': 'x' * content_size, 'tags': [f'tag{i}' for i in range(tags)]}
+        for _ in range(documents)
+    ]
+
+
+def legacy_output(article: dict) -> dict:
+    """The previous article_output, converting ObjectIDs to str up front"""
+    return {'id': str(article['_id']), 'content': article['content'], 'tags': article['tags']}
+
+
+def render_legacy(articles: list) -> bytes:
+    """A plain list returned from a view: jsonable_encoder walks it, then json.dumps renders it"""
+    return JSONResponse(jsonable_encoder([legacy_output(article) for article in articles])).body
+
+
+def render_current(articles: list) -> bytes:
+    """An ArticleJSONResponse returned from a view: orjson renders it and encodes ObjectIDs"""
+    return ArticleJSONResponse([article_output(article) for article in articles]).body
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.serialization')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--content-size', type=int, default=500)
+    parser.add_argument('--tags', type=int, default=5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    articles = make_articles(args.documents, args.content_size, args.tags)
+    results = {}
+    for name, render in (('legacy', render_legacy), ('current', render_current)):
+        best = min(timeit.repeat(lambda: render(articles), number=1, repeat=args.repeat))
+        results[name] = best
+        print(f'{name:<8} {best * 1000:9.2f} ms total {best / args.documents * 1e6:8.3f} us/document')
+    print(f'speedup  {results["legacy"] / results["current"]:9.2f}x')
+
+
+if __name__ == '__main__':
+    main()